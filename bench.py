@@ -0,0 +1,568 @@
+"""Бенчмарки и нагрузочные тесты: python bench.py <имя>.
+Временные базы, фейковый Bot API и замеры живут здесь, чтобы main.py содержал только код приложения"""
+import os
+import argparse
+import asyncio
+import random
+import hmac
+import hashlib
+import gzip
+import time
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict
+from contextlib import asynccontextmanager
+
+from aiogram import Bot, Dispatcher
+from aiogram.enums import ParseMode
+from aiogram.filters import CommandStart
+from aiogram.types import Message
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.telegram import TelegramAPIServer
+from fastapi import Request
+from fastapi.responses import HTMLResponse, Response
+from sqlalchemy import create_engine, select, insert, func
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from main import (
+    BOT_TOKEN, WEBAPP_SECRET_KEY, PROVABLY_FAIR, SQLITE_BUSY_TIMEOUT, UPDATE_WORKERS, HTML_TEMPLATE,
+    User, NFT, Case, CaseNFT, OpeningHistory,
+    run_migrations, case_catalog, poll_updates, get_mini_app_page, export_opening_history,
+    _hour_index, _history_row, _percentile,
+    AuthService, CaseSampler, CaseService, AsyncCaseService, UserService, AsyncUserService, FairnessService,
+    HistoryBuffer, Leaderboards, LeaderboardWindow, DropTelemetry,
+    OutboundHTTP, SharedPoolAiohttpSession, UpdateQueue, SendScheduler, SendPriority
+)
+
+def benchmark_case_sampler(sizes=(10, 100, 10_000), draws: int = 20_000) -> List[dict]:
+    """Сравнение random.choices и скомпилированного семплера на кейсах разного размера"""
+    bench_case_id = -1
+    results = []
+    for size in sizes:
+        case_nfts = [{'id': i, 'chance': random.uniform(0.01, 10.0)} for i in range(size)]
+        
+        start = time.perf_counter()
+        for _ in range(draws):
+            CaseService.open_case(case_nfts)
+        legacy = time.perf_counter() - start
+        
+        CaseService.invalidate_sampler(bench_case_id)
+        start = time.perf_counter()
+        for _ in range(draws):
+            CaseService.open_case(case_nfts, case_id=bench_case_id)
+        compiled = time.perf_counter() - start
+        CaseService.invalidate_sampler(bench_case_id)
+        
+        results.append({
+            'items': size,
+            'choices_per_sec': draws / legacy,
+            'sampler_per_sec': draws / compiled,
+            'speedup': legacy / compiled,
+        })
+        print(f"{size:>6} items: random.choices {draws / legacy:>12,.0f}/s | "
+              f"alias sampler {draws / compiled:>12,.0f}/s | x{legacy / compiled:.1f}")
+    return results
+
+async def _measure_loop_latency(open_one, opens: int, concurrency: int, probe_interval: float) -> dict:
+    """Гоняет открытия кейсов и параллельно меряет, насколько опаздывает event loop"""
+    loop = asyncio.get_running_loop()
+    delays = []
+    finished = asyncio.Event()
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def probe():
+        # Имитация лёгкого вебхука: задержка сверх probe_interval — время блокировки loop
+        while not finished.is_set():
+            started = loop.time()
+            await asyncio.sleep(probe_interval)
+            delays.append(loop.time() - started - probe_interval)
+    
+    async def worker(i: int):
+        async with semaphore:
+            await open_one(i)
+    
+    probe_task = asyncio.create_task(probe())
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(opens)))
+    elapsed = time.perf_counter() - started
+    finished.set()
+    await probe_task
+    
+    delays.sort()
+    return {
+        'opens_per_sec': opens / elapsed,
+        'p50_ms': _percentile(delays, 50) * 1000,
+        'p99_ms': _percentile(delays, 99) * 1000,
+        'max_ms': (delays[-1] if delays else 0.0) * 1000,
+    }
+
+@asynccontextmanager
+async def _scratch_database():
+    """Временная SQLite-база с тестовым кейсом и пользователями для бенчмарков"""
+    import tempfile
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "scratch.db")
+        sync_engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT})
+        run_migrations(sync_engine)
+        scratch_engine = create_async_engine(f"sqlite+aiosqlite:///{path}", connect_args={"timeout": SQLITE_BUSY_TIMEOUT})
+        SyncSession = sessionmaker(autoflush=False, bind=sync_engine)
+        ScratchSession = async_sessionmaker(scratch_engine, autoflush=False, expire_on_commit=False)
+        
+        with SyncSession() as db:
+            case = Case(name="Benchmark", price_stars=10)
+            nfts = [NFT(name=f"NFT {i}", rarity="common", price=10 + i) for i in range(20)]
+            db.add(case)
+            db.add_all(nfts)
+            db.flush()
+            db.add_all(CaseNFT(case_id=case.id, nft_id=nft.id, chance=1.0 + i) for i, nft in enumerate(nfts))
+            # Пользователи создаются заранее, чтобы мерить открытия, а не регистрацию
+            users = [User(telegram_id=base + i, stars_balance=10 ** 12) for base in (1_000_000, 2_000_000) for i in range(100)]
+            db.add_all(users)
+            db.flush()
+            if PROVABLY_FAIR:
+                for user in users:
+                    FairnessService.first_seed(db, user.id)
+            db.commit()
+            case_id = case.id
+        
+        try:
+            yield SyncSession, ScratchSession, case_id
+        finally:
+            await scratch_engine.dispose()
+            sync_engine.dispose()
+            # Каталог временной базы не должен остаться в кэше процесса
+            case_catalog.bump()
+
+async def load_test_webhook_latency(opens: int = 2000, concurrency: int = 50, probe_interval: float = 0.005) -> dict:
+    """Нагрузочный тест: p99 задержки вебхука при параллельных открытиях, sync vs async сессии"""
+    async with _scratch_database() as (SyncSession, ScratchSession, case_id):
+        async def sync_open(i: int):
+            with SyncSession() as db:
+                user = UserService.get_or_create_user(db, 1_000_000 + i % 100)
+                nft = CaseService.open_case(CaseService.get_case_nfts(db, case_id), case_id=case_id)
+                UserService.add_nft_to_inventory(db, user.id, nft['id'], case_id)
+        
+        async def async_open(i: int):
+            async with ScratchSession() as db:
+                user = await AsyncUserService.get_or_create_user(db, 2_000_000 + i % 100)
+                nfts = await AsyncCaseService.get_case_nfts(db, case_id)
+                nft = AsyncCaseService.open_case(nfts, case_id=case_id)
+                await AsyncUserService.add_nft_to_inventory(db, user.id, nft['id'], case_id)
+        
+        results = {}
+        for mode, open_one in (('sync', sync_open), ('async', async_open)):
+            results[mode] = await _measure_loop_latency(open_one, opens, concurrency, probe_interval)
+            print(f"{mode:>5}: {results[mode]['opens_per_sec']:>8,.0f} opens/s | webhook delay "
+                  f"p50 {results[mode]['p50_ms']:.2f} ms, p99 {results[mode]['p99_ms']:.2f} ms, "
+                  f"max {results[mode]['max_ms']:.2f} ms")
+    return results
+
+async def benchmark_multi_open(counts=(1, 10, 100), opens: int = 5000) -> List[dict]:
+    """Строк в секунду (UserNFT + OpeningHistory) при открытии пачками по N кейсов"""
+    results = []
+    async with _scratch_database() as (_, ScratchSession, case_id):
+        async with ScratchSession() as db:
+            user = await AsyncUserService.get_or_create_user(db, 2_000_000)
+        
+        for count in counts:
+            requests = max(1, opens // count)
+            started = time.perf_counter()
+            for _ in range(requests):
+                async with ScratchSession() as db:
+                    await AsyncCaseService.open_cases_transaction(db, user.id, case_id, count)
+            elapsed = time.perf_counter() - started
+            
+            rows = 2 * requests * count
+            results.append({'count': count, 'rows_per_sec': rows / elapsed, 'opens_per_sec': requests * count / elapsed})
+            print(f"N={count:>3}: {rows / elapsed:>10,.0f} rows/s | {requests * count / elapsed:>10,.0f} opens/s")
+    return results
+
+async def benchmark_history_buffer(opens: int = 3000, concurrency: int = 20) -> dict:
+    """Задержка одиночного открытия: OpeningHistory в транзакции против write-behind буфера"""
+    results = {}
+    async with _scratch_database() as (_, ScratchSession, case_id):
+        async with ScratchSession() as db:
+            user_ids = (await db.execute(select(User.id))).scalars().all()
+        
+        for mode in ('inline', 'write-behind'):
+            history = HistoryBuffer(ScratchSession) if mode == 'write-behind' else None
+            if history is not None:
+                await history.start()
+            latencies = []
+            semaphore = asyncio.Semaphore(concurrency)
+            
+            async def open_one(i: int):
+                async with semaphore:
+                    started = time.perf_counter()
+                    async with ScratchSession() as db:
+                        await AsyncCaseService.open_case_transaction(db, user_ids[i % len(user_ids)], case_id, history)
+                    latencies.append(time.perf_counter() - started)
+            
+            started = time.perf_counter()
+            await asyncio.gather(*(open_one(i) for i in range(opens)))
+            elapsed = time.perf_counter() - started
+            if history is not None:
+                await history.stop()
+            
+            latencies.sort()
+            results[mode] = {
+                'opens_per_sec': opens / elapsed,
+                'avg_ms': sum(latencies) / len(latencies) * 1000,
+                'p99_ms': _percentile(latencies, 99) * 1000,
+            }
+            print(f"{mode:>12}: {opens / elapsed:>8,.0f} opens/s | open latency avg {results[mode]['avg_ms']:.2f} ms, "
+                  f"p99 {results[mode]['p99_ms']:.2f} ms")
+            if history is not None:
+                results[mode]['buffer'] = history.metrics()
+                metrics = results[mode]['buffer']
+                print(f"{'':>12}  {metrics['flushes']} flushes, avg batch {metrics['avg_batch']:.0f} rows, "
+                      f"flush avg {metrics['avg_flush_ms']:.2f} ms, max row age {metrics['max_row_age_ms']:.0f} ms")
+        
+        async with ScratchSession() as db:
+            stored = (await db.execute(select(func.count(OpeningHistory.id)))).scalar_one()
+        assert stored == 2 * opens, f"expected {2 * opens} history rows, found {stored}"
+    return results
+
+def benchmark_leaderboards(opens: int = 200_000, users: int = 50_000, reads: int = 10_000) -> dict:
+    """Стоимость обновления топов на открытии и чтения топ-100 без базы"""
+    boards = Leaderboards()
+    rng = random.Random(1)
+    now = datetime.utcnow()
+    events = [
+        (rng.randrange(users), rng.choice((10, 25, 100)), rng.randint(1, 5000), now - timedelta(minutes=rng.randrange(60 * 24 * 10)))
+        for _ in range(opens)
+    ]
+    events.sort(key=lambda event: event[3])
+    
+    started = time.perf_counter()
+    for user_id, price, drop, at in events:
+        boards.record(user_id, price, 1, drop, at)
+    record_time = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for i in range(reads):
+        boards.top(LeaderboardWindow.BOARDS[i % 3], ('all', 'day', 'week')[i % 3], 100)
+    read_time = time.perf_counter() - started
+    
+    # Проверка против полного пересчёта
+    for window in ('all', 'day', 'week'):
+        spent = {}
+        hour = _hour_index(now)
+        for user_id, price, _, at in events:
+            hours = Leaderboards.WINDOWS[window]
+            if hours is None or _hour_index(at) > hour - hours:
+                spent[user_id] = spent.get(user_id, 0) + price
+        expected = sorted(((-score, user_id) for user_id, score in spent.items()))[:100]
+        actual = [(-entry['score'], entry['user_id']) for entry in boards.top('spent', window, 100)]
+        assert actual == expected, f"{window} spent leaderboard differs from full recount"
+    
+    result = {'records_per_sec': opens / record_time, 'read_us': read_time / reads * 1e6}
+    print(f"record {result['records_per_sec']:,.0f} opens/s (10 days of opens, window expiry included) | "
+          f"top-100 read {result['read_us']:.1f} us")
+    return result
+
+async def benchmark_export(rows: int = 200_000) -> dict:
+    """Скорость выгрузки и пик памяти: он должен зависеть от размера порции, а не от числа строк"""
+    import tracemalloc
+    
+    async def run(fmt: str, compress: bool, end: Optional[datetime] = None) -> tuple:
+        started = time.perf_counter()
+        size = 0
+        async for data in export_opening_history(fmt, end=end, compress=compress, session_factory=ScratchSession):
+            size += len(data)
+        return time.perf_counter() - started, size
+    
+    async def peak_memory(end: Optional[datetime] = None) -> float:
+        # tracemalloc замедляет выгрузку в разы, поэтому память меряется отдельным прогоном
+        tracemalloc.start()
+        await run('ndjson', False, end)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak / 2 ** 20
+    
+    results = {}
+    async with _scratch_database() as (SyncSession, ScratchSession, case_id):
+        with SyncSession() as db:
+            user_id = db.execute(select(User.id)).scalars().first()
+            nft_ids = db.execute(select(CaseNFT.nft_id).where(CaseNFT.case_id == case_id)).scalars().all()
+            now = datetime.utcnow()
+            # Первая десятая часть строк на день старше: по ней меряется память маленькой выгрузки
+            db.execute(insert(OpeningHistory), [
+                _history_row(user_id, case_id, nft_ids[i % len(nft_ids)], 10, None, None, None, None,
+                             now - timedelta(days=1) if i < rows // 10 else now)
+                for i in range(rows)
+            ])
+            db.commit()
+        
+        for fmt, compress in (('ndjson', False), ('csv', False), ('ndjson', True)):
+            elapsed, size = await run(fmt, compress)
+            name = fmt + ('.gz' if compress else '')
+            results[name] = {'rows_per_sec': rows / elapsed, 'bytes': size}
+            print(f"{name:>10}: {rows / elapsed:>10,.0f} rows/s | {size / 2 ** 20:>6.1f} MB")
+        
+        results['peak_mb'] = {rows // 10: await peak_memory(now - timedelta(hours=1)), rows: await peak_memory()}
+        print("peak memory: " + ", ".join(f"{count:,} rows {peak:.1f} MB" for count, peak in results['peak_mb'].items()))
+    return results
+
+def benchmark_drop_telemetry(draws: int = 1_000_000) -> dict:
+    """Цена записи выпадения на открытии относительно самого выбора NFT"""
+    telemetry = DropTelemetry()
+    sampler = CaseSampler([{'id': i, 'chance': 1.0 + i} for i in range(50)])
+    sample = sampler.sample
+    
+    started = time.perf_counter()
+    for _ in range(draws):
+        sample()
+    bare = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    for _ in range(draws):
+        telemetry.record(1, sampler.odds_hash, sample()['id'])
+    recorded = time.perf_counter() - started
+    
+    overhead_ns = (recorded - bare) / draws * 1e9
+    print(f"sample {bare / draws * 1e9:.0f} ns | sample + record {recorded / draws * 1e9:.0f} ns | overhead {overhead_ns:.0f} ns")
+    return {'sample_ns': bare / draws * 1e9, 'record_overhead_ns': overhead_ns}
+
+def benchmark_init_data_verification(iterations: int = 100_000) -> dict:
+    """Проверок init_data в секунду: как раньше (ключ на каждый запрос), с готовым ключом и с кэшем"""
+    fields = {
+        'auth_date': str(int(time.time())),
+        'query_id': 'AAHdF6IQAAAAAN0XohDhrOrc',
+        'user': '%7B%22id%22%3A279058397%2C%22first_name%22%3A%22Vlad%22%2C%22username%22%3A%22vdkfrost%22%7D',
+    }
+    data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(fields.items()))
+    signature = hmac.new(WEBAPP_SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
+    init_data = '&'.join(f"{k}={v}" for k, v in fields.items()) + f"&hash={signature}"
+    
+    def legacy():
+        AuthService.check_init_data_signature(init_data, hashlib.sha256(BOT_TOKEN.encode()).digest())
+    
+    def precomputed_key():
+        AuthService.check_init_data_signature(init_data, WEBAPP_SECRET_KEY)
+    
+    def cached():
+        AuthService.verify_telegram_init_data(init_data)
+    
+    results = {}
+    for name, verify in (('legacy', legacy), ('secret_cached', precomputed_key), ('init_data_cached', cached)):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            verify()
+        results[name] = iterations / (time.perf_counter() - started)
+        print(f"{name:>16}: {results[name]:>12,.0f} verifications/s")
+    AuthService._verified.pop(signature)
+    return results
+
+def benchmark_mini_app_page(requests: int = 20_000) -> dict:
+    """Ответов в секунду для страницы: как раньше, gzip на лету, предсжатая и 304"""
+    page = get_mini_app_page()
+    
+    def make_request(*headers) -> Request:
+        return Request({'type': 'http', 'method': 'GET', 'path': '/', 'headers': list(headers)})
+    
+    accept = (b'accept-encoding', b'gzip, deflate, br')
+    compressed_request = make_request(accept)
+    revalidate_request = make_request(accept, (b'if-none-match', page.etags['br'].encode()))
+    
+    variants = (
+        ('as_is', lambda: HTMLResponse(HTML_TEMPLATE)),
+        ('gzip_per_request', lambda: Response(gzip.compress(HTML_TEMPLATE.encode()), media_type="text/html")),
+        ('precompressed', lambda: page.response(compressed_request)),
+        ('not_modified', lambda: page.response(revalidate_request)),
+    )
+    results = {}
+    for name, render in variants:
+        started = time.perf_counter()
+        for _ in range(requests):
+            render()
+        results[name] = requests / (time.perf_counter() - started)
+        print(f"{name:>16}: {results[name]:>10,.0f} responses/s")
+    sizes = {encoding: len(body) for encoding, body in page.bodies.items()}
+    print(f"{'body bytes':>16}: {sizes}")
+    return results
+
+async def _serve_fake_bot_api(total_updates: int, batch: int, calls: Optional[list] = None):
+    """Локальный фейковый Bot API: отдаёт total_updates сообщений через getUpdates, остальные методы отвечают ok"""
+    from aiohttp import web
+    
+    def make_update(update_id: int) -> dict:
+        chat = {'id': 100_000 + update_id % 500, 'type': 'private'}
+        return {
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': chat,
+                'from': {'id': chat['id'], 'is_bot': False, 'first_name': 'Bench'},
+                'text': '/start'
+            }
+        }
+    
+    async def handle(request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        params = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.post())
+        
+        if method.lower() == 'getupdates':
+            offset = int(params.get('offset') or 1)
+            if offset > total_updates:
+                await asyncio.sleep(0.05)
+                return web.json_response({'ok': True, 'result': []})
+            last = min(total_updates, offset + batch - 1)
+            return web.json_response({'ok': True, 'result': [make_update(i) for i in range(offset, last + 1)]})
+        
+        if method.lower() in ('sendmessage', 'editmessagetext'):
+            chat_id = int(params.get('chat_id') or 0)
+            if calls is not None:
+                calls.append((time.monotonic(), chat_id))
+            return web.json_response({'ok': True, 'result': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', '')
+            }})
+        return web.json_response({'ok': True, 'result': True})
+    
+    server = web.Application()
+    server.router.add_route('*', '/bot{token}/{method}', handle)
+    runner = web.AppRunner(server)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+def _bench_dispatcher(session_factory) -> Dispatcher:
+    """Dispatcher с обработчиком /start той же формы, что у бота: пользователь из базы и ответ через Bot API.
+    Без обработчиков апдейты отбрасывались бы сразу, и замер показывал бы только разбор JSON"""
+    bench_dp = Dispatcher()
+    
+    @bench_dp.message(CommandStart())
+    async def start(message: Message):
+        async with session_factory() as db:
+            user = await AsyncUserService.get_or_create_user(
+                db,
+                message.from_user.id,
+                message.from_user.username,
+                message.from_user.first_name,
+                message.from_user.last_name
+            )
+        await message.answer(f"Баланс: <b>{user.stars_balance}</b> ⭐")
+    
+    return bench_dp
+
+async def benchmark_polling(updates: int = 5000, parallelism: int = UPDATE_WORKERS, batch: int = 100) -> dict:
+    """Пропускная способность обработчика /start в режиме polling против локального фейкового Bot API"""
+    calls = []
+    runner, base_url = await _serve_fake_bot_api(updates, batch, calls)
+    pool = OutboundHTTP()
+    session = SharedPoolAiohttpSession(pool, api=TelegramAPIServer.from_base(base_url))
+    bench_bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    queue = UpdateQueue(maxsize=batch * 2, workers=parallelism)
+    
+    async with _scratch_database() as (_, ScratchSession, _):
+        bench_dp = _bench_dispatcher(ScratchSession)
+        await queue.start(bench_dp, bench_bot)
+        started = time.perf_counter()
+        polling = asyncio.create_task(poll_updates(bench_bot, bench_dp, queue, timeout=0))
+        try:
+            while queue.processed + queue.failed < updates:
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - started
+        finally:
+            polling.cancel()
+            await asyncio.gather(polling, return_exceptions=True)
+            await queue.stop()
+            await session.close()
+            await pool.close()
+            await runner.cleanup()
+    
+    if len(calls) != updates - queue.failed:
+        raise AssertionError(f"{updates - queue.failed} updates handled, but {len(calls)} replies sent")
+    result = {'updates_per_sec': updates / elapsed, **queue.metrics(), 'http': pool.metrics()}
+    print(f"parallelism {parallelism}: {updates / elapsed:,.0f} updates/s, "
+          f"failed {queue.failed}, avg wait {result['avg_wait_ms']:.1f} ms, "
+          f"connections opened {pool.stats['connections_created']}, reused {pool.stats['connections_reused']}")
+    return result
+
+async def benchmark_send_scheduler(messages: int = 300, chats: int = 40) -> dict:
+    """Рассылка через SendScheduler на фейковый Bot API: проверка лимитов, склейки и задержек"""
+    calls = []
+    runner, base_url = await _serve_fake_bot_api(0, 1, calls)
+    pool = OutboundHTTP()
+    session = SharedPoolAiohttpSession(pool, api=TelegramAPIServer.from_base(base_url))
+    bench_bot = Bot(token=BOT_TOKEN, session=session)
+    scheduler = SendScheduler(bench_bot)
+    await scheduler.start()
+    try:
+        started = time.monotonic()
+        futures = [
+            scheduler.send_message(
+                1_000 + i % chats,
+                f"Уведомление {i}",
+                SendPriority.HIGH if i % 10 == 0 else SendPriority.LOW
+            )
+            for i in range(messages)
+        ]
+        await asyncio.gather(*futures)
+        elapsed = time.monotonic() - started
+    finally:
+        await scheduler.stop()
+        await session.close()
+        await pool.close()
+        await runner.cleanup()
+    
+    # Максимум запросов в любом окне в 1 секунду — глобально и на один чат
+    def max_per_second(timestamps: List[float]) -> int:
+        best, start = 0, 0
+        for end in range(len(timestamps)):
+            while timestamps[end] - timestamps[start] >= 1.0:
+                start += 1
+            best = max(best, end - start + 1)
+        return best
+    
+    per_chat: Dict[int, List[float]] = {}
+    for at, chat_id in calls:
+        per_chat.setdefault(chat_id, []).append(at)
+    result = {
+        **scheduler.metrics(),
+        'elapsed_sec': elapsed,
+        'max_global_per_sec': max_per_second([at for at, _ in calls]),
+        'max_chat_per_sec': max(max_per_second(times) for times in per_chat.values()),
+    }
+    print(f"{messages} messages -> {result['sent']} requests in {elapsed:.2f}s, coalesced {result['coalesced']}, "
+          f"peak {result['max_global_per_sec']}/s global, {result['max_chat_per_sec']}/s per chat, "
+          f"latency p50 {result['latency_p50_ms']:.0f} ms p99 {result['latency_p99_ms']:.0f} ms")
+    return result
+
+# Бенчмарки, доступные из командной строки: python bench.py <имя>
+BENCHMARKS = {
+    'sampler': lambda args: benchmark_case_sampler(),
+    'webhook-latency': lambda args: load_test_webhook_latency(),
+    'multi-open': lambda args: benchmark_multi_open(),
+    'history-buffer': lambda args: benchmark_history_buffer(),
+    'leaderboards': lambda args: benchmark_leaderboards(),
+    'export': lambda args: benchmark_export(),
+    'drop-telemetry': lambda args: benchmark_drop_telemetry(),
+    'init-data': lambda args: benchmark_init_data_verification(),
+    'mini-app-page': lambda args: benchmark_mini_app_page(),
+    'polling': lambda args: benchmark_polling(parallelism=args.parallelism),
+    'send-scheduler': lambda args: benchmark_send_scheduler(),
+}
+
+def main(argv: Optional[List[str]] = None):
+    """Запуск: python bench.py <имя> [--parallelism N]"""
+    parser = argparse.ArgumentParser(description="Gift Battle benchmarks")
+    parser.add_argument("name", choices=sorted(BENCHMARKS))
+    parser.add_argument("--parallelism", type=int, default=UPDATE_WORKERS, help="сколько апдейтов обрабатывать одновременно (polling)")
+    args = parser.parse_args(argv)
+    
+    result = BENCHMARKS[args.name](args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,61 @@
 import os
+import argparse
+import asyncio
 import logging
 import random
 import json
 import hmac
+import math
 import hashlib
-from datetime import datetime
+import secrets
+import heapq
+import bisect
+import ssl
+import gzip
+import zlib
+import csv
+import io
+import sys
+import time
+from itertools import chain
+from collections import OrderedDict, deque
+from enum import IntEnum
+from datetime import datetime, timedelta
+from urllib.parse import unquote
 from typing import Optional, List, Dict
 from contextlib import asynccontextmanager
 
 import aiohttp
-from aiogram import Bot, Dispatcher, types, F
+import numpy as np
+import brotli
+import certifi
+import orjson
+from aiogram import Bot, Dispatcher, types, F, __version__ as aiogram_version
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.client.default import DefaultBotProperties
-from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import HTMLResponse, JSONResponse
+from aiogram.client.session.aiohttp import AiohttpSession
+from fastapi import FastAPI, Request, HTTPException, Depends, Query
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
 import uvicorn
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, Boolean, Float, ForeignKey, TIMESTAMP, Text, func
+from sqlalchemy import create_engine, Column, Integer, String, BigInteger, Boolean, Float, ForeignKey, TIMESTAMP, Text, func, event
+from sqlalchemy import select, update, insert, and_, or_, Index, MetaData, Table, cast, literal, inspect as sa_inspect
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import sessionmaker, Session, relationship, attributes
 from sqlalchemy.pool import StaticPool
-from pydantic import BaseModel
+from sqlalchemy.schema import CreateColumn
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
+from jose import jwt, JWTError
 
 # Загружаем переменные окружения
 load_dotenv()
@@ -39,9 +70,69 @@ ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "momnetk")
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./bot.db")
 PORT = int(os.getenv("PORT", 8000))
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+RUN_MODE = os.getenv("RUN_MODE", "webhook")  # webhook или polling (python main.py --polling)
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", 30))  # Таймаут long polling getUpdates, секунды
+
+# Настройки авторизации Mini App
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", 86400))  # Сколько секунд после auth_date init_data принимается (и живёт в кэше)
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", 10000))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 100000))  # telegram_id -> User.id
+# Секретный ключ для проверки init_data вычисляется один раз при запуске
+WEBAPP_SECRET_KEY = hashlib.sha256(BOT_TOKEN.encode()).digest() if BOT_TOKEN else b""
+# Сессионные токены Mini App: выдаются один раз после проверки init_data
+SESSION_TOKEN_SECRET = os.getenv("SESSION_TOKEN_SECRET") or hmac.new(b"session-token", (BOT_TOKEN or "").encode(), hashlib.sha256).hexdigest()
+SESSION_TOKEN_TTL = int(os.getenv("SESSION_TOKEN_TTL", 3600))
+SESSION_TOKEN_ALGORITHM = "HS256"
+# Секрет вебхука: Telegram присылает его в X-Telegram-Bot-Api-Secret-Token (A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hmac.new(b"webhook-secret", (BOT_TOKEN or "").encode(), hashlib.sha256).hexdigest()
+
+# Очередь входящих апдейтов вебхука
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", 1000))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", 10000))  # Сколько последних update_id помнить
+# Общий пул исходящих HTTP-соединений (Bot API и другие клиенты)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 100))
+HTTP_POOL_PER_HOST = int(os.getenv("HTTP_POOL_PER_HOST", 0))  # 0 — без отдельного лимита на хост
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 60))  # Сколько держать простаивающее соединение, секунды
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", 300))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 60))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", 10))
+
+# Лимиты исходящих сообщений Bot API (сообщений в секунду)
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 30))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", 1))
+SEND_GROUP_RATE = float(os.getenv("SEND_GROUP_RATE", 20 / 60))
+SEND_CONCURRENCY = int(os.getenv("SEND_CONCURRENCY", 16))  # Одновременных запросов sendMessage
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # Без токена /internal/metrics отключён
+ADMIN_API_TOKEN = os.getenv("ADMIN_API_TOKEN", "")  # Без токена /internal/export отключён
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 5000))  # Строк истории за одну порцию выгрузки
+
+# Кэширование страницы Mini App в браузере и на прокси (секунды)
+MINI_APP_CACHE_MAX_AGE = int(os.getenv("MINI_APP_CACHE_MAX_AGE", 86400))
 
 # Настройки экономики
 SELL_PERCENT = 0.7  # Продажа NFT за 70% от цены
+MAX_OPEN_COUNT = int(os.getenv("MAX_OPEN_COUNT", 100))  # Максимум кейсов за одно открытие
+# Максимум id в одном запросе массовой продажи: IN-список ограничен числом bind-параметров SQLite
+MAX_SELL_IDS = int(os.getenv("MAX_SELL_IDS", 1000))
+# Сколько секунд SQLite ждёт блокировку записи: транзакция открытия пишет в несколько таблиц,
+# и при десятках параллельных открытий стандартных 5 секунд не хватает
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", 30))
+# Provably fair: выпадение считается из HMAC-SHA256(server_seed, client_seed:nonce) вместо random
+PROVABLY_FAIR = os.getenv("PROVABLY_FAIR", "1") == "1"
+FAIR_SEED_CACHE_SIZE = int(os.getenv("FAIR_SEED_CACHE_SIZE", 100000))
+# Отложенная запись OpeningHistory: сброс пачкой раз в HISTORY_FLUSH_INTERVAL мс или по HISTORY_FLUSH_ROWS строк
+HISTORY_FLUSH_INTERVAL = int(os.getenv("HISTORY_FLUSH_INTERVAL", 200))
+HISTORY_FLUSH_ROWS = int(os.getenv("HISTORY_FLUSH_ROWS", 1000))
+HISTORY_BUFFER_LIMIT = int(os.getenv("HISTORY_BUFFER_LIMIT", 100000))  # Больше строк буфер не держит, пока база недоступна
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", 100))  # Сколько мест хранится в каждом топе
+# Почасовые и посуточные агрегаты opening_history: компактор дописывает строки новее водяного знака
+ROLLUP_INTERVAL = int(os.getenv("ROLLUP_INTERVAL", 60))  # Секунды между проходами компактора
+ROLLUP_LAG = int(os.getenv("ROLLUP_LAG", 300))  # Не трогать строки моложе: их ещё может дописывать HistoryBuffer
+ROLLUP_SPAN_HOURS = int(os.getenv("ROLLUP_SPAN_HOURS", 24))  # Сколько часов истории за одну транзакцию
+# Телеметрия выпадений: счётчики в памяти сбрасываются в case_drop_stats раз в DROP_STATS_INTERVAL секунд
+DROP_STATS_INTERVAL = int(os.getenv("DROP_STATS_INTERVAL", 60))
+DROP_ALERT_P_VALUE = float(os.getenv("DROP_ALERT_P_VALUE", 1e-4))  # Ниже — частоты не сходятся с шансами
 
 # Инициализация базы данных
 engine = create_engine(
@@ -52,6 +143,27 @@ engine = create_engine(
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# Асинхронный движок для обработчиков в event loop (aiosqlite для SQLite, asyncpg для Postgres)
+_ASYNC_DRIVERS = {
+    "sqlite://": "sqlite+aiosqlite://",
+    "postgres://": "postgresql+asyncpg://",
+    "postgresql://": "postgresql+asyncpg://",
+    "postgresql+psycopg2://": "postgresql+asyncpg://",
+}
+
+def to_async_database_url(url: str) -> str:
+    for prefix, async_prefix in _ASYNC_DRIVERS.items():
+        if url.startswith(prefix):
+            return async_prefix + url[len(prefix):]
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", to_async_database_url(DATABASE_URL))
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    connect_args={"timeout": SQLITE_BUSY_TIMEOUT} if ASYNC_DATABASE_URL.startswith("sqlite") else {}
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 # Модели базы данных
 class User(Base):
     __tablename__ = "users"
@@ -64,6 +176,9 @@ class User(Base):
     stars_balance = Column(BigInteger, default=0)
     total_spent_stars = Column(BigInteger, default=0)
     total_cases_opened = Column(Integer, default=0)
+    # Активная пара сидов provably fair (fairness_seeds.id) и следующий nonce для неё
+    fair_seed_id = Column(Integer)
+    fair_nonce = Column(Integer, nullable=False, default=0, server_default='0')
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
     updated_at = Column(TIMESTAMP, default=datetime.utcnow, onupdate=datetime.utcnow)
 
@@ -98,6 +213,10 @@ class CaseNFT(Base):
     nft_id = Column(Integer, ForeignKey("nfts.id", ondelete="CASCADE"))
     chance = Column(Float, nullable=False)
     is_active = Column(Boolean, default=True)
+    
+    __table_args__ = (
+        Index("ix_case_nfts_case_active", "case_id", "is_active"),
+    )
 
 class UserNFT(Base):
     __tablename__ = "user_nfts"
@@ -109,6 +228,82 @@ class UserNFT(Base):
     sold_price = Column(Integer)
     opened_from_case_id = Column(Integer, ForeignKey("cases.id", ondelete="SET NULL"))
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Страница инвентаря — короткий проход по индексу в порядке (created_at, id)
+        Index("ix_user_nfts_user_sold_created_id", "user_id", "is_sold", "created_at", "id"),
+        # Частичный индекс по непроданным NFT: продажа и подсчёты по конкретному NFT
+        Index(
+            "ix_user_nfts_unsold_user_nft", "user_id", "nft_id",
+            sqlite_where=is_sold == False,
+            postgresql_where=is_sold == False
+        ),
+    )
+
+# Сводка непроданного инвентаря по редкостям: обновляется в тех же транзакциях, что открытия и продажи,
+# чтобы профиль читался по первичному ключу, а не агрегатом по user_nfts
+class UserInventorySummary(Base):
+    __tablename__ = "user_inventory_summary"
+    
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    rarity = Column(String, primary_key=True)
+    item_count = Column(Integer, nullable=False, default=0)
+    sell_value = Column(BigInteger, nullable=False, default=0)  # Сумма int(price * SELL_PERCENT)
+
+# Агрегаты открытий по (час или сутки, кейс, редкость): дашборды читают их вместо opening_history
+class _OpeningStatsColumns:
+    bucket = Column(TIMESTAMP, primary_key=True)
+    case_id = Column(Integer, primary_key=True)
+    rarity = Column(String, primary_key=True)
+    opens = Column(Integer, nullable=False, default=0)
+    stars_spent = Column(BigInteger, nullable=False, default=0)  # Выручка в звёздах
+    payout_value = Column(BigInteger, nullable=False, default=0)  # Сумма NFT.price выпавших NFT
+
+class OpeningStatsHourly(_OpeningStatsColumns, Base):
+    __tablename__ = "opening_stats_hourly"
+
+class OpeningStatsDaily(_OpeningStatsColumns, Base):
+    __tablename__ = "opening_stats_daily"
+
+class RollupWatermark(Base):
+    __tablename__ = "rollup_watermarks"
+    
+    name = Column(String, primary_key=True)
+    watermark = Column(TIMESTAMP, nullable=False)  # История до этого момента (не включая) уже в агрегатах
+
+# Сколько раз выпал каждый NFT кейса при данной версии шансов (odds_hash семплера)
+class CaseDropStats(Base):
+    __tablename__ = "case_drop_stats"
+    
+    case_id = Column(Integer, primary_key=True)
+    odds_hash = Column(String, primary_key=True)  # Счётчики разных настроек шансов не смешиваются
+    nft_id = Column(Integer, primary_key=True)
+    drops = Column(BigInteger, nullable=False, default=0)
+    updated_at = Column(TIMESTAMP, default=datetime.utcnow)
+
+# Шансы кейса, при которых были открытия с данным odds_hash: по ним перепроверяется история после смены шансов
+class CaseOddsSnapshot(Base):
+    __tablename__ = "case_odds_snapshots"
+    
+    case_id = Column(Integer, primary_key=True)
+    odds_hash = Column(String, primary_key=True)
+    odds = Column(Text, nullable=False)  # JSON [[nft_id, chance], ...] — ровно то, из чего считается odds_hash
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+
+class FairnessSeed(Base):
+    __tablename__ = "fairness_seeds"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    server_seed = Column(String, nullable=False)  # Секрет до ротации, затем раскрывается игроку
+    server_seed_hash = Column(String, nullable=False)  # sha256(server_seed), показывается заранее
+    client_seed = Column(String, nullable=False)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    revealed_at = Column(TIMESTAMP)
+    
+    __table_args__ = (
+        Index("ix_fairness_seeds_user", "user_id"),
+    )
 
 class OpeningHistory(Base):
     __tablename__ = "opening_history"
@@ -118,10 +313,259 @@ class OpeningHistory(Base):
     case_id = Column(Integer, ForeignKey("cases.id", ondelete="CASCADE"))
     nft_id = Column(Integer, ForeignKey("nfts.id", ondelete="CASCADE"))
     stars_spent = Column(Integer, nullable=False)
+    # Provably fair: пара сидов, nonce и равномерное значение, по которому выбран NFT
+    seed_id = Column(Integer, ForeignKey("fairness_seeds.id", ondelete="SET NULL"))
+    nonce = Column(Integer)
+    roll = Column(Float)
+    odds_hash = Column(String)  # odds_hash семплера при открытии: по нему видно, что шансы с тех пор менялись
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_opening_history_user_created", "user_id", "created_at"),
+        Index("ix_opening_history_case_created", "case_id", "created_at"),
+        # id во втором столбце: выгрузка идёт по (created_at, id) прямо по индексу, без сортировки
+        Index("ix_opening_history_created", "created_at", "id"),
+    )
+
+# Миграции схемы: применяются по порядку, номер применённой версии хранится в schema_migrations.
+# Каждая миграция идемпотентна, чтобы её можно было накатить на базу, созданную через create_all.
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", TIMESTAMP, default=datetime.utcnow)
+)
+
+# Первая версия схемы, зафиксированная как есть: миграция 1 создаёт именно её, а всё, что
+# появилось в моделях позже, добавляют следующие миграции. create_all текущих моделей здесь нельзя —
+# тогда «версия 1» менялась бы вместе с моделями.
+baseline_schema = MetaData()
+Table(
+    "users", baseline_schema,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("telegram_id", BigInteger, unique=True, index=True, nullable=False),
+    Column("username", String),
+    Column("first_name", String),
+    Column("last_name", String),
+    Column("stars_balance", BigInteger),
+    Column("total_spent_stars", BigInteger),
+    Column("total_cases_opened", Integer),
+    Column("created_at", TIMESTAMP),
+    Column("updated_at", TIMESTAMP)
+)
+Table(
+    "nfts", baseline_schema,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String, nullable=False),
+    Column("description", Text),
+    Column("rarity", String, nullable=False),
+    Column("price", Integer, nullable=False),
+    Column("image_url", String),
+    Column("is_active", Boolean),
+    Column("created_at", TIMESTAMP)
+)
+Table(
+    "cases", baseline_schema,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String, nullable=False),
+    Column("description", Text),
+    Column("price_stars", Integer, nullable=False),
+    Column("image_url", String),
+    Column("is_active", Boolean),
+    Column("created_at", TIMESTAMP)
+)
+Table(
+    "case_nfts", baseline_schema,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("case_id", Integer, ForeignKey("cases.id", ondelete="CASCADE")),
+    Column("nft_id", Integer, ForeignKey("nfts.id", ondelete="CASCADE")),
+    Column("chance", Float, nullable=False),
+    Column("is_active", Boolean)
+)
+Table(
+    "user_nfts", baseline_schema,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE")),
+    Column("nft_id", Integer, ForeignKey("nfts.id", ondelete="CASCADE")),
+    Column("is_sold", Boolean),
+    Column("sold_price", Integer),
+    Column("opened_from_case_id", Integer, ForeignKey("cases.id", ondelete="SET NULL")),
+    Column("created_at", TIMESTAMP)
+)
+Table(
+    "opening_history", baseline_schema,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE")),
+    Column("case_id", Integer, ForeignKey("cases.id", ondelete="CASCADE")),
+    Column("nft_id", Integer, ForeignKey("nfts.id", ondelete="CASCADE")),
+    Column("stars_spent", Integer, nullable=False),
+    Column("created_at", TIMESTAMP)
+)
+
+def _create_indexes(connection, *models):
+    for model in models:
+        for index in model.__table__.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+def _add_columns(connection, model, *names):
+    existing = {column['name'] for column in sa_inspect(connection).get_columns(model.__tablename__)}
+    for name in names:
+        if name not in existing:
+            column = CreateColumn(model.__table__.c[name]).compile(dialect=connection.dialect)
+            connection.exec_driver_sql(f"ALTER TABLE {model.__tablename__} ADD COLUMN {column}")
+
+def _provably_fair_schema(connection):
+    FairnessSeed.__table__.create(bind=connection, checkfirst=True)
+    _add_columns(connection, User, 'fair_seed_id', 'fair_nonce')
+    _add_columns(connection, OpeningHistory, 'seed_id', 'nonce', 'roll')
+
+def _odds_snapshot_schema(connection):
+    CaseOddsSnapshot.__table__.create(bind=connection, checkfirst=True)
+    _add_columns(connection, OpeningHistory, 'odds_hash')
+
+def _recreate_index(connection, model, name: str):
+    """Пересоздание индекса, определение которого изменилось в модели"""
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    index.drop(bind=connection, checkfirst=True)
+    index.create(bind=connection)
+
+def _sell_price_expression(dialect_name: str):
+    """int(price * SELL_PERCENT) на стороне базы"""
+    sell_price = NFT.price * literal(SELL_PERCENT, Float)
+    if dialect_name == 'postgresql':
+        # CAST в Postgres округляет, а int() в Python отбрасывает дробную часть
+        sell_price = func.floor(sell_price)
+    return cast(sell_price, Integer)
+
+def rebuild_inventory_summary(connection, user_id: Optional[int] = None, nft_ids: Optional[List[int]] = None):
+    """Пересчёт сводки из user_nfts: всей, одного пользователя или владельцев nft_ids (после смены цен NFT)"""
+    summary = UserInventorySummary.__table__
+    delete_statement = summary.delete()
+    aggregate = select(
+        UserNFT.user_id,
+        NFT.rarity,
+        func.count(UserNFT.id),
+        func.sum(_sell_price_expression(connection.dialect.name))
+    ).join(
+        NFT, UserNFT.nft_id == NFT.id
+    ).where(
+        UserNFT.is_sold == False
+    ).group_by(UserNFT.user_id, NFT.rarity)
+    if user_id is not None:
+        delete_statement = delete_statement.where(summary.c.user_id == user_id)
+        aggregate = aggregate.where(UserNFT.user_id == user_id)
+    if nft_ids is not None:
+        owners = select(UserNFT.user_id).where(UserNFT.nft_id.in_(nft_ids), UserNFT.is_sold == False).distinct()
+        delete_statement = delete_statement.where(summary.c.user_id.in_(owners))
+        aggregate = aggregate.where(UserNFT.user_id.in_(owners))
+    
+    connection.execute(delete_statement)
+    connection.execute(summary.insert().from_select(['user_id', 'rarity', 'item_count', 'sell_value'], aggregate))
+
+def _inventory_summary_schema(connection):
+    UserInventorySummary.__table__.create(bind=connection, checkfirst=True)
+    rebuild_inventory_summary(connection)
+
+def _opening_stats_schema(connection):
+    for model in (OpeningStatsHourly, OpeningStatsDaily, RollupWatermark):
+        model.__table__.create(bind=connection, checkfirst=True)
 
-# Создание таблиц
-Base.metadata.create_all(bind=engine)
+MIGRATIONS = [
+    (1, "initial schema", lambda connection: baseline_schema.create_all(bind=connection)),
+    (2, "hot path indexes", lambda connection: _create_indexes(connection, CaseNFT, UserNFT, OpeningHistory)),
+    (3, "provably fair seeds", _provably_fair_schema),
+    (4, "user inventory summary", _inventory_summary_schema),
+    (5, "opening stats rollups", _opening_stats_schema),
+    (6, "case drop stats", lambda connection: CaseDropStats.__table__.create(bind=connection, checkfirst=True)),
+    (7, "opening odds snapshots", _odds_snapshot_schema),
+    (8, "history export order index", lambda connection: _recreate_index(connection, OpeningHistory, "ix_opening_history_created")),
+]
+
+def run_migrations(bind=None) -> List[int]:
+    """Применяет недостающие миграции, каждую в отдельной транзакции"""
+    bind = bind if bind is not None else engine
+    schema_migrations.create(bind=bind, checkfirst=True)
+    with bind.connect() as connection:
+        applied_versions = set(connection.execute(select(schema_migrations.c.version)).scalars())
+    
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version in applied_versions:
+            continue
+        with bind.begin() as connection:
+            migrate(connection)
+            connection.execute(insert(schema_migrations).values(version=version, description=description))
+        logger.info(f"Applied migration {version}: {description}")
+        applied.append(version)
+    return applied
+
+# Потоковые запросы: сортировка всего результата держала бы его в памяти или на диске,
+# поэтому check_query_plans требует, чтобы порядок давал индекс
+_INDEX_ORDERED_QUERIES = {'export_opening_history', 'export_opening_history (after)', 'verify_fairness'}
+
+def _service_queries(dialect_name: str) -> List[tuple]:
+    """(имя, запрос) горячих путей: те же построители, что вызывают сервисы, с типовыми параметрами"""
+    now = datetime.utcnow()
+    return [
+        ('UserService.get_or_create_user_id', _user_id_query(1)),
+        ('CaseService.load_case_nfts', _case_nfts_query(1)),
+        ('_charge_for_open', _charge_for_open(1, 100, 10)),
+        ('UserService.get_user_nfts', _user_nfts_query(1)),
+        ('AsyncUserService.get_user_nfts_page', _inventory_page_query(1, 50)),
+        ('AsyncUserService.get_user_nfts_page (after)', _inventory_page_query(1, 50, (now, 10))),
+        # Фильтр по rarity сюда не входит: rarity лежит в nfts, и индекса по (user_id, rarity, id) нет —
+        # страница идёт по ix_user_nfts_user_sold_created_id и отбрасывает чужие редкости после join
+        ('AsyncUserService.get_user_nfts_page (nft_id)', _inventory_page_query(1, 50, nft_id=1)),
+        ('UserService.sell_nft', _unsold_user_nft_query(1, 1)),
+        ('UserService.sell_nfts (ids)', _bulk_sell_statement(dialect_name, 1, [1, 2, 3], None, None)),
+        ('UserService.sell_nfts (rarity)', _bulk_sell_statement(dialect_name, 1, None, 'rare', None)),
+        ('UserService.sell_nfts (nft_id)', _bulk_sell_statement(dialect_name, 1, None, None, 1)),
+        ('UserService.get_profile', _profile_query(1)),
+        ('get_opening_stats', _opening_stats_query('day', now - timedelta(days=30), now, [1])),
+        ('StatsRollup.compact', _rollup_delta_query(dialect_name, now - timedelta(hours=1), now)),
+        ('get_drop_report', _drop_counts_query(1, 'odds')),
+        ('export_opening_history', _export_query(now - timedelta(days=1), now)),
+        ('export_opening_history (after)', _export_query(now - timedelta(days=1), now, after=(now - timedelta(hours=1), 10))),
+        ('verify_fairness', _fairness_history_query(1000)),
+        ('verify_fairness (odds snapshot)', _odds_snapshot_query(1, 'odds')),
+    ]
+
+def check_query_plans(bind=None) -> Dict[str, List[str]]:
+    """EXPLAIN каждого запроса сервисов; AssertionError, если хоть один читает таблицу целиком
+    или потоковый запрос из _INDEX_ORDERED_QUERIES сортирует результат"""
+    bind = bind if bind is not None else engine
+    plans = {}
+    failures = []
+    with bind.connect() as connection:
+        is_postgres = connection.dialect.name == 'postgresql'
+        if is_postgres:
+            # На маленьких таблицах Postgres и так выберет Seq Scan; без него остаётся только индекс
+            connection.exec_driver_sql("SET enable_seqscan = off")
+        
+        for name, query in _service_queries(connection.dialect.name):
+            compiled = query.compile(dialect=connection.dialect, compile_kwargs={"render_postcompile": True})
+            params = tuple(compiled.params[key] for key in compiled.positiontup) if compiled.positional else compiled.params
+            if is_postgres:
+                rows = connection.exec_driver_sql(f"EXPLAIN {compiled}", params).all()
+                plan = [row[0] for row in rows]
+                unindexed = [line for line in plan if 'Seq Scan' in line]
+                if name in _INDEX_ORDERED_QUERIES:
+                    # "Sort  (" и "Incremental Sort  (": узлы сортировки, а не строки Sort Key
+                    unindexed += [line for line in plan if 'Sort  (' in line]
+            else:
+                rows = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", params).all()
+                plan = [row[-1] for row in rows]
+                unindexed = [line for line in plan if line.startswith('SCAN')]
+                if name in _INDEX_ORDERED_QUERIES:
+                    unindexed += [line for line in plan if line.startswith('USE TEMP B-TREE') and 'ORDER BY' in line]
+            plans[name] = plan
+            if unindexed:
+                failures.append(f"{name}: {'; '.join(unindexed)}")
+    
+    if failures:
+        raise AssertionError("Queries without index:\n" + "\n".join(failures))
+    return plans
 
 # Pydantic модели для API
 class NFTSchema(BaseModel):
@@ -150,14 +594,869 @@ class OpenCaseRequest(BaseModel):
     case_id: int
     init_data: str
 
+class InitDataRequest(BaseModel):
+    init_data: str
+
+class RotateSeedRequest(BaseModel):
+    client_seed: Optional[str] = None  # Без client_seed генерируется случайный
+
+class SellNFTsRequest(BaseModel):
+    user_nft_ids: Optional[List[int]] = Field(None, max_length=MAX_SELL_IDS)
+    rarity: Optional[str] = None
+    nft_id: Optional[int] = None
+    all: bool = False  # Продать весь инвентарь, если другие фильтры не заданы
+
+# Кэши
+class LRUCache:
+    """Ограниченный LRU-кэш с необязательным сроком жизни записей и счётчиками попаданий"""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.time():
+            del self._data[key]
+            self.misses += 1
+            return default
+        
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value, expires_at: Optional[float] = None):
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+    
+    def pop(self, key):
+        self._data.pop(key, None)
+    
+    def clear(self):
+        self._data.clear()
+    
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
 # Сервисы
+class InsufficientBalanceError(Exception):
+    """Недостаточно звёзд для открытия кейса"""
+
+class FairnessSeedMissingError(Exception):
+    """У пользователя нет закоммиченной пары сидов: открывать без показанного заранее хэша нельзя"""
+
+def _charge_for_open(user_id: int, price: int, count: int = 1):
+    """Условное списание: баланс проверяется и уменьшается одним UPDATE, без гонки двойного списания.
+    Тем же UPDATE резервируются count nonce активной пары сидов provably fair"""
+    total = price * count
+    values = {
+        'stars_balance': User.stars_balance - total,
+        'total_spent_stars': User.total_spent_stars + total,
+        'total_cases_opened': User.total_cases_opened + count,
+    }
+    columns = [User.stars_balance]
+    if PROVABLY_FAIR:
+        values['fair_nonce'] = User.fair_nonce + count
+        columns += [User.fair_seed_id, User.fair_nonce]
+    return update(User).where(
+        User.id == user_id,
+        User.stars_balance >= total
+    ).values(**values).returning(*columns).execution_options(synchronize_session=False)
+
+def _inventory_delta_statement(dialect_name: str, user_id: int, deltas: Dict[str, list]):
+    """INSERT ... ON CONFLICT DO UPDATE: прибавляет [количество, стоимость] к сводке по каждой редкости"""
+    dialect_insert = postgresql_insert if dialect_name == 'postgresql' else sqlite_insert
+    statement = dialect_insert(UserInventorySummary).values([
+        {'user_id': user_id, 'rarity': rarity, 'item_count': count, 'sell_value': value}
+        for rarity, (count, value) in deltas.items()
+    ])
+    return statement.on_conflict_do_update(
+        index_elements=[UserInventorySummary.user_id, UserInventorySummary.rarity],
+        set_={
+            'item_count': UserInventorySummary.item_count + statement.excluded.item_count,
+            'sell_value': UserInventorySummary.sell_value + statement.excluded.sell_value,
+        }
+    )
+
+def _opened_inventory_deltas(nfts) -> Dict[str, list]:
+    deltas = {}
+    for nft in nfts:
+        delta = deltas.setdefault(nft['rarity'], [0, 0])
+        delta[0] += 1
+        delta[1] += int(nft['price'] * SELL_PERCENT)
+    return deltas
+
+def _sold_inventory_deltas(sold, rarities: Dict[int, str]) -> Dict[str, list]:
+    """Отрицательные дельты по строкам (user_nft_id, sold_price, nft_id) из _bulk_sell_statement"""
+    deltas = {}
+    for _, sold_price, nft_id in sold:
+        delta = deltas.setdefault(rarities[nft_id], [0, 0])
+        delta[0] -= 1
+        delta[1] -= sold_price
+    return deltas
+
+def _profile_query(user_id: int):
+    return select(
+        User.stars_balance,
+        User.total_spent_stars,
+        User.total_cases_opened,
+        UserInventorySummary.rarity,
+        UserInventorySummary.item_count,
+        UserInventorySummary.sell_value
+    ).outerjoin(
+        UserInventorySummary, UserInventorySummary.user_id == User.id
+    ).where(User.id == user_id)
+
+def _profile_from_rows(rows) -> Optional[dict]:
+    if not rows:
+        return None
+    balance, total_spent, total_opened = rows[0][:3]
+    by_rarity = {
+        rarity: {'count': count, 'sell_value': value}
+        for _, _, _, rarity, count, value in rows
+        if rarity is not None and count
+    }
+    return {
+        'balance': balance,
+        'total_spent_stars': total_spent,
+        'total_cases_opened': total_opened,
+        'inventory': {
+            'count': sum(item['count'] for item in by_rarity.values()),
+            'sell_value': sum(item['sell_value'] for item in by_rarity.values()),
+            'by_rarity': by_rarity,
+        },
+    }
+
+def _is_openable(entry: 'CatalogEntry') -> bool:
+    return entry.case is not None and entry.case['is_active'] and entry.sampler is not None
+
+class CaseSampler:
+    """Alias-таблица Воуза: выбор NFT из кейса за O(1) после сборки за O(n)"""
+    __slots__ = ('items', 'prob', 'alias', 'size', 'odds', 'odds_hash', 'snapshot_saved')
+    
+    def __init__(self, case_nfts: List[dict]):
+        # Порядок по id: таблица не зависит от порядка строк из базы, и roll из истории можно перепроверить
+        items = sorted((item for item in case_nfts if item['chance'] > 0), key=lambda item: item['id'])
+        total = sum(item['chance'] for item in items)
+        if not items or total <= 0:
+            raise ValueError("Total of weights must be greater than zero")
+        
+        size = len(items)
+        scaled = [item['chance'] * size / total for item in items]
+        prob = [1.0] * size
+        alias = list(range(size))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] = (scaled[more] + scaled[less]) - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # Оставшиеся ячейки (включая погрешность округления) заполнены целиком
+        
+        self.items = items
+        self.prob = prob
+        self.alias = alias
+        self.size = size
+        # Версия шансов для телеметрии выпадений и истории открытий
+        self.odds = [[item['id'], item['chance']] for item in items]
+        self.odds_hash = hashlib.sha1(orjson.dumps(self.odds)).hexdigest()[:16]
+        # Снимок шансов уже закоммичен в case_odds_snapshots (достаточно одной записи на семплер)
+        self.snapshot_saved = False
+    
+    def sample(self, rng=random) -> dict:
+        return self.pick(rng.random())
+    
+    def pick(self, roll: float) -> dict:
+        """NFT по равномерному значению roll из [0, 1): один и тот же roll всегда даёт один и тот же NFT"""
+        u = roll * self.size
+        i = int(u)
+        if i >= self.size:
+            i = self.size - 1
+        if u - i < self.prob[i]:
+            return self.items[i]
+        return self.items[self.alias[i]]
+
+def fair_roll(server_seed: str, client_seed: str, nonce: int) -> float:
+    """Равномерное значение из [0, 1): старшие 52 бита HMAC-SHA256(server_seed, "client_seed:nonce")"""
+    digest = hmac.digest(server_seed.encode(), f"{client_seed}:{nonce}".encode(), 'sha256')
+    return (int.from_bytes(digest[:7], 'big') >> 4) / 4503599627370496.0  # 2 ** 52
+
+class FairnessService:
+    # seed_id -> (server_seed, client_seed): пара сидов неизменна, ротация создаёт новую
+    _seeds = LRUCache(FAIR_SEED_CACHE_SIZE)
+    
+    @staticmethod
+    def new_seed(user_id: int, client_seed: Optional[str] = None) -> FairnessSeed:
+        server_seed = secrets.token_hex(32)
+        return FairnessSeed(
+            user_id=user_id,
+            server_seed=server_seed,
+            server_seed_hash=hashlib.sha256(server_seed.encode()).hexdigest(),
+            client_seed=client_seed or secrets.token_hex(8)
+        )
+    
+    @staticmethod
+    def _assign_seed(user_id: int, seed_id: int, nonce: int = 0):
+        return update(User).where(User.id == user_id).values(
+            fair_seed_id=seed_id,
+            fair_nonce=nonce
+        ).execution_options(synchronize_session=False)
+    
+    @staticmethod
+    def first_seed(db: Session, user_id: int):
+        """Первая пара сидов: коммитится вместе с пользователем, чтобы её хэш был виден до первого открытия"""
+        seed = FairnessService.new_seed(user_id)
+        db.add(seed)
+        db.flush()
+        db.execute(FairnessService._assign_seed(user_id, seed.id))
+    
+    @staticmethod
+    async def afirst_seed(db: AsyncSession, user_id: int):
+        seed = FairnessService.new_seed(user_id)
+        db.add(seed)
+        await db.flush()
+        await db.execute(FairnessService._assign_seed(user_id, seed.id))
+    
+    @staticmethod
+    async def aensure_seed(db: AsyncSession, user_id: int):
+        """Пара сидов для пользователя, созданного до provably fair; коммитится отдельно от открытий"""
+        seed_id = (await db.execute(
+            select(User.fair_seed_id).where(User.id == user_id).with_for_update()
+        )).scalar_one()
+        if seed_id is None:
+            await FairnessService.afirst_seed(db, user_id)
+        await db.commit()
+    
+    @staticmethod
+    def reserve(db: Session, user_id: int, charged, count: int = 1) -> tuple:
+        """(seed_id, (server_seed, client_seed), первый nonce) для count открытий по строке из _charge_for_open.
+        Пара сидов только читается: она закоммичена заранее, иначе списание откатывается"""
+        if not PROVABLY_FAIR:
+            return None, None, None
+        
+        seed_id = charged.fair_seed_id
+        if seed_id is None:
+            db.rollback()
+            raise FairnessSeedMissingError(f"User {user_id} has no committed seed pair")
+        
+        seeds = FairnessService._seeds.get(seed_id)
+        if seeds is None:
+            seed = db.get(FairnessSeed, seed_id)
+            seeds = (seed.server_seed, seed.client_seed)
+            FairnessService._seeds.set(seed_id, seeds)
+        return seed_id, seeds, charged.fair_nonce - count
+    
+    @staticmethod
+    async def areserve(db: AsyncSession, user_id: int, charged, count: int = 1) -> tuple:
+        if not PROVABLY_FAIR:
+            return None, None, None
+        
+        seed_id = charged.fair_seed_id
+        if seed_id is None:
+            await db.rollback()
+            raise FairnessSeedMissingError(f"User {user_id} has no committed seed pair")
+        
+        seeds = FairnessService._seeds.get(seed_id)
+        if seeds is None:
+            seed = await db.get(FairnessSeed, seed_id)
+            seeds = (seed.server_seed, seed.client_seed)
+            FairnessService._seeds.set(seed_id, seeds)
+        return seed_id, seeds, charged.fair_nonce - count
+    
+    @staticmethod
+    def draw(sampler: CaseSampler, seeds: Optional[tuple], first_nonce: Optional[int], count: int = 1) -> List[tuple]:
+        """count выпадений (nft, nonce, roll); без пары сидов — обычный random"""
+        if seeds is None:
+            return [(sampler.sample(), None, None) for _ in range(count)]
+        
+        server_seed, client_seed = seeds
+        draws = []
+        for nonce in range(first_nonce, first_nonce + count):
+            roll = fair_roll(server_seed, client_seed, nonce)
+            draws.append((sampler.pick(roll), nonce, roll))
+        return draws
+    
+    @staticmethod
+    def _public(seed: FairnessSeed, nonce: int) -> dict:
+        return {'server_seed_hash': seed.server_seed_hash, 'client_seed': seed.client_seed, 'nonce': nonce}
+    
+    @staticmethod
+    async def aget_state(db: AsyncSession, user_id: int) -> dict:
+        """Текущая пара сидов для показа игроку: хэш server_seed, client_seed и следующий nonce"""
+        seed_id, nonce = (await db.execute(
+            select(User.fair_seed_id, User.fair_nonce).where(User.id == user_id)
+        )).one()
+        if seed_id is None:
+            return await FairnessService.arotate(db, user_id)
+        return FairnessService._public(await db.get(FairnessSeed, seed_id), nonce)
+    
+    @staticmethod
+    async def arotate(db: AsyncSession, user_id: int, client_seed: Optional[str] = None) -> dict:
+        """Новая пара сидов; прежний server_seed раскрывается, чтобы игрок мог проверить прошлые открытия"""
+        old_seed_id, used_nonces = (await db.execute(
+            select(User.fair_seed_id, User.fair_nonce).where(User.id == user_id).with_for_update()
+        )).one()
+        seed = FairnessService.new_seed(user_id, client_seed)
+        db.add(seed)
+        await db.flush()
+        await db.execute(FairnessService._assign_seed(user_id, seed.id))
+        
+        result = FairnessService._public(seed, 0)
+        if old_seed_id is not None:
+            old_seed = await db.get(FairnessSeed, old_seed_id)
+            old_seed.revealed_at = datetime.utcnow()
+            result['previous'] = {
+                'server_seed': old_seed.server_seed,
+                'server_seed_hash': old_seed.server_seed_hash,
+                'client_seed': old_seed.client_seed,
+                'nonces_used': used_nonces
+            }
+        await db.commit()
+        return result
+
+def _fairness_history_query(after_id: int = 0):
+    return select(
+        OpeningHistory.id,
+        OpeningHistory.case_id,
+        OpeningHistory.nft_id,
+        OpeningHistory.nonce,
+        OpeningHistory.roll,
+        OpeningHistory.odds_hash,
+        FairnessSeed.server_seed,
+        FairnessSeed.client_seed
+    ).join(
+        FairnessSeed, OpeningHistory.seed_id == FairnessSeed.id
+    ).where(
+        OpeningHistory.id > after_id
+    ).order_by(OpeningHistory.id)
+
+def _odds_snapshot_query(case_id: int, odds_hash: str):
+    return select(CaseOddsSnapshot.odds).where(
+        CaseOddsSnapshot.case_id == case_id,
+        CaseOddsSnapshot.odds_hash == odds_hash
+    )
+
+def _snapshot_sampler(db: Session, case_id: int, odds_hash: str) -> Optional[CaseSampler]:
+    """Семплер из снимка шансов; None, если снимка нет или он не соответствует своему хэшу"""
+    odds = db.execute(_odds_snapshot_query(case_id, odds_hash)).scalar_one_or_none()
+    if odds is None:
+        return None
+    sampler = CaseSampler([{'id': nft_id, 'chance': chance} for nft_id, chance in orjson.loads(odds)])
+    return sampler if sampler.odds_hash == odds_hash else None
+
+def verify_fairness(db: Session, chunk_size: int = 50_000, after_id: int = 0, max_reported: int = 100) -> dict:
+    """Перепроверка открытий с сидами: roll заново из HMAC, NFT — семплером кейса по этому roll.
+    История читается потоком порциями по chunk_size строк. Несовпадение roll означает подмену записи.
+    Если odds_hash строки не совпадает с текущим, шансы менялись после открытия: NFT сверяется со снимком
+    из case_odds_snapshots, а без снимка строка считается в unverifiable_odds_changed.
+    У строк до миграции 7 хэша нет, их NFT сверяется с текущими шансами"""
+    query = _fairness_history_query(after_id).execution_options(yield_per=chunk_size)
+    
+    samplers = {}
+    snapshots = {}
+    checked = 0
+    roll_mismatches = []
+    outcome_mismatches = []
+    roll_mismatch_count = 0
+    outcome_mismatch_count = 0
+    unverifiable = 0
+    odds_changed = 0
+    last_id = after_id
+    started = time.perf_counter()
+    for rows in db.execute(query).partitions():
+        for history_id, case_id, nft_id, nonce, roll, odds_hash, server_seed, client_seed in rows:
+            if fair_roll(server_seed, client_seed, nonce) != roll:
+                roll_mismatch_count += 1
+                if len(roll_mismatches) < max_reported:
+                    roll_mismatches.append(history_id)
+                continue
+            
+            if case_id not in samplers:
+                samplers[case_id] = case_catalog.get(db, case_id).sampler
+            sampler = samplers[case_id]
+            if odds_hash is not None and (sampler is None or odds_hash != sampler.odds_hash):
+                # Шансы менялись после открытия: NFT сверяется со снимком шансов на момент открытия
+                key = (case_id, odds_hash)
+                if key not in snapshots:
+                    snapshots[key] = _snapshot_sampler(db, case_id, odds_hash)
+                sampler = snapshots[key]
+                if sampler is None:
+                    odds_changed += 1
+                    continue
+            if sampler is None:
+                unverifiable += 1
+            elif sampler.pick(roll)['id'] != nft_id:
+                outcome_mismatch_count += 1
+                if len(outcome_mismatches) < max_reported:
+                    outcome_mismatches.append(history_id)
+        checked += len(rows)
+        last_id = rows[-1][0]
+    elapsed = time.perf_counter() - started
+    
+    return {
+        'checked': checked,
+        'last_id': last_id,
+        'roll_mismatches': roll_mismatch_count,
+        'outcome_mismatches': outcome_mismatch_count,
+        'unverifiable': unverifiable,
+        'unverifiable_odds_changed': odds_changed,
+        'roll_mismatch_ids': roll_mismatches,
+        'outcome_mismatch_ids': outcome_mismatches,
+        'rows_per_sec': checked / elapsed if elapsed else float('inf'),
+    }
+
+def _history_row(user_id: int, case_id: int, nft_id: int, stars_spent: int, seed_id: Optional[int], nonce: Optional[int], roll: Optional[float],
+                 odds_hash: Optional[str], created_at: datetime) -> dict:
+    return {
+        'user_id': user_id,
+        'case_id': case_id,
+        'nft_id': nft_id,
+        'stars_spent': stars_spent,
+        'seed_id': seed_id,
+        'nonce': nonce,
+        'roll': roll,
+        'odds_hash': odds_hash,
+        'created_at': created_at,
+    }
+
+def _odds_snapshot_statement(dialect_name: str, case_id: int, sampler: CaseSampler):
+    """INSERT ... ON CONFLICT DO NOTHING: снимок пишется в транзакции открытия, поэтому есть у каждой строки истории"""
+    dialect_insert = postgresql_insert if dialect_name == 'postgresql' else sqlite_insert
+    return dialect_insert(CaseOddsSnapshot).values(
+        case_id=case_id,
+        odds_hash=sampler.odds_hash,
+        odds=orjson.dumps(sampler.odds).decode()
+    ).on_conflict_do_nothing(index_elements=[CaseOddsSnapshot.case_id, CaseOddsSnapshot.odds_hash])
+
+class HistoryBuffer:
+    """Write-behind буфер OpeningHistory: строки копятся в памяти и вставляются пачкой в фоне.
+    Строки кладутся после commit открытия; при падении процесса теряется не больше одного интервала"""
+    
+    def __init__(self, session_factory=None, interval_ms: int = HISTORY_FLUSH_INTERVAL, max_rows: int = HISTORY_FLUSH_ROWS,
+                 limit: int = HISTORY_BUFFER_LIMIT, rollup_lag: int = ROLLUP_LAG):
+        self.session_factory = session_factory if session_factory is not None else AsyncSessionLocal
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self.limit = limit
+        self.rollup_lag = timedelta(seconds=rollup_lag)
+        self._rows: deque = deque()
+        self._pending_since: Optional[float] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._started_at = 0.0
+        self.added = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.rejected = 0  # Строки, которые база не принимает (IntegrityError/DataError), — в лог и отброшены
+        self.dropped = 0  # Вытеснены лимитом буфера, пока база была недоступна
+        self.late_rows = 0  # Записаны позже ROLLUP_LAG: компактор StatsRollup мог их уже пропустить
+        self.max_batch = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.max_row_age = 0.0
+    
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+    
+    def add(self, rows: List[dict]):
+        """Кладёт строки в буфер; можно вызывать и из других потоков"""
+        if self._pending_since is None:
+            self._pending_since = time.perf_counter()
+        self._rows.extend(rows)
+        self.added += len(rows)
+        if len(self._rows) >= self.max_rows and self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+    
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._started_at = time.perf_counter()
+        self._task = asyncio.create_task(self._run(), name="history-buffer")
+    
+    async def stop(self):
+        """Останавливает фоновый сброс и записывает всё, что осталось в буфере"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        while self._rows:
+            pending = len(self._rows)
+            await self.flush()
+            if len(self._rows) >= pending:
+                logger.error(f"Lost {len(self._rows)} opening history rows on shutdown")
+                break
+    
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+    
+    async def _insert(self, rows: List[dict]) -> tuple:
+        """Пакетная вставка rows. Пачка с IntegrityError/DataError делится пополам, пока плохая строка
+        не останется одна; такие строки возвращаются отдельно, чтобы одна строка не держала весь буфер.
+        Возвращает (записано, отвергнутые строки, незаписанные строки, ошибка) — последние две при сбое базы"""
+        written = 0
+        rejected = []
+        batches = [rows]
+        while batches:
+            batch = batches.pop()
+            try:
+                async with self.session_factory() as db:
+                    await db.execute(insert(OpeningHistory), batch)
+                    await db.commit()
+            except (IntegrityError, DataError) as e:
+                if len(batch) == 1:
+                    rejected.append((batch[0], e))
+                else:
+                    middle = len(batch) // 2
+                    batches.append(batch[middle:])
+                    batches.append(batch[:middle])
+                continue
+            except Exception as e:
+                unwritten = batch + [row for remaining in reversed(batches) for row in remaining]
+                return written, rejected, unwritten, e
+            written += len(batch)
+        return written, rejected, [], None
+    
+    async def flush(self) -> int:
+        """Пакетная вставка всего, что накопилось; возвращает число записанных строк.
+        При сбое базы незаписанные строки возвращаются в начало буфера (не больше limit)"""
+        async with self._lock:
+            count = len(self._rows)
+            if not count:
+                return 0
+            rows = [self._rows.popleft() for _ in range(count)]
+            pending_since = self._pending_since
+            self._pending_since = time.perf_counter() if self._rows else None
+            
+            started = time.perf_counter()
+            written, rejected, unwritten, error = await self._insert(rows)
+            finished = time.perf_counter()
+            
+            for row, e in rejected:
+                logger.error(f"Opening history row rejected by the database, dropped: {row}: {e}")
+            self.rejected += len(rejected)
+            if written:
+                late_before = datetime.utcnow() - self.rollup_lag
+                failed = {id(row) for row, _ in rejected} | {id(row) for row in unwritten}
+                late = sum(1 for row in rows if id(row) not in failed and row['created_at'] < late_before)
+                if late:
+                    self.late_rows += late
+                    logger.warning(f"Flushed {late} opening history rows older than ROLLUP_LAG; opening stats may miss them")
+            if error is not None:
+                self.failed_flushes += 1
+                self._rows.extendleft(reversed(unwritten))
+                self._pending_since = pending_since
+                logger.error(f"Opening history flush failed, {len(unwritten)} rows requeued: {error}")
+                overflow = len(self._rows) - self.limit
+                if overflow > 0:
+                    for _ in range(overflow):
+                        self._rows.popleft()
+                    self.dropped += overflow
+                    logger.error(f"Opening history buffer is over its limit ({self.limit}), dropped {overflow} oldest rows")
+            
+            if written:
+                self.flushes += 1
+                self.flushed += written
+                self.max_batch = max(self.max_batch, written)
+                self.total_flush_time += finished - started
+                self.max_flush_time = max(self.max_flush_time, finished - started)
+                if pending_since is not None:
+                    self.max_row_age = max(self.max_row_age, finished - pending_since)
+            return written
+    
+    def metrics(self) -> dict:
+        uptime = time.perf_counter() - self._started_at if self._started_at else 0.0
+        return {
+            'pending': len(self._rows),
+            'added': self.added,
+            'flushed': self.flushed,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'rejected': self.rejected,
+            'dropped': self.dropped,
+            'late_rows': self.late_rows,
+            'avg_batch': self.flushed / self.flushes if self.flushes else 0.0,
+            'max_batch': self.max_batch,
+            'rows_per_sec': self.flushed / uptime if uptime else 0.0,
+            'avg_flush_ms': self.total_flush_time / self.flushes * 1000 if self.flushes else 0.0,
+            'max_flush_ms': self.max_flush_time * 1000,
+            'max_row_age_ms': self.max_row_age * 1000,
+        }
+
+def _hour_index(moment: datetime) -> int:
+    return int((moment - datetime(1970, 1, 1)).total_seconds() // 3600)
+
+class Leaderboard:
+    """Очки всех пользователей и отсортированный топ из size лучших: чтение топа за O(K).
+    set() рассчитан на рост очков; после уменьшения очков нужно вызвать rebuild()"""
+    
+    def __init__(self, size: int = LEADERBOARD_SIZE):
+        self.size = size
+        self.scores: Dict[int, int] = {}
+        self._top: List[tuple] = []  # (-score, user_id) по возрастанию
+    
+    def set(self, user_id: int, score: int):
+        old = self.scores.get(user_id)
+        self.scores[user_id] = score
+        if old is not None and (len(self._top) < self.size or (-old, user_id) <= self._top[-1]):
+            index = bisect.bisect_left(self._top, (-old, user_id))
+            if index < len(self._top) and self._top[index] == (-old, user_id):
+                del self._top[index]
+        
+        entry = (-score, user_id)
+        if len(self._top) < self.size or entry < self._top[-1]:
+            bisect.insort(self._top, entry)
+            if len(self._top) > self.size:
+                self._top.pop()
+    
+    def rebuild(self):
+        self._top = sorted(heapq.nsmallest(self.size, ((-score, user_id) for user_id, score in self.scores.items() if score > 0)))
+    
+    def top(self, limit: int) -> List[tuple]:
+        return [(user_id, -score) for score, user_id in self._top[:limit]]
+
+class LeaderboardWindow:
+    """Топы за окно в hours часов (None — за всё время). Окно собирается из часовых корзин:
+    при сдвиге часа старые корзины вычитаются, а топы пересобираются один раз"""
+    BOARDS = ('spent', 'opens', 'best_drop')
+    
+    def __init__(self, hours: Optional[int], size: int = LEADERBOARD_SIZE):
+        self.hours = hours
+        self.boards = {name: Leaderboard(size) for name in self.BOARDS}
+        # час -> user_id -> [потрачено, открытий, лучший дроп]
+        self._buckets: Dict[int, Dict[int, list]] = {}
+        self._hour = 0
+    
+    def add(self, hour: int, user_id: int, spent: int, opens: int, best_drop: int):
+        if self.hours is not None:
+            if hour <= self._hour - self.hours:
+                return
+            stats = self._buckets.setdefault(hour, {}).setdefault(user_id, [0, 0, 0])
+            stats[0] += spent
+            stats[1] += opens
+            stats[2] = max(stats[2], best_drop)
+        
+        boards = self.boards
+        boards['spent'].set(user_id, boards['spent'].scores.get(user_id, 0) + spent)
+        boards['opens'].set(user_id, boards['opens'].scores.get(user_id, 0) + opens)
+        if best_drop > boards['best_drop'].scores.get(user_id, 0):
+            boards['best_drop'].set(user_id, best_drop)
+    
+    def advance(self, hour: int):
+        """Сдвигает окно к часу hour и вычитает вышедшие из него корзины"""
+        if hour <= self._hour:
+            return
+        self._hour = hour
+        if self.hours is None:
+            return
+        
+        expired = [bucket_hour for bucket_hour in self._buckets if bucket_hour <= hour - self.hours]
+        if not expired:
+            return
+        
+        # Ничего здесь не должно падать: окно уже сдвинуто, и прерванный сдвиг оставил бы его очки неверными.
+        # Записи best_drop может не быть вовсе — add не пишет нулевой дроп
+        spent, opens, best_drop = (self.boards[name].scores for name in self.BOARDS)
+        touched = set()
+        for bucket_hour in expired:
+            for user_id, (bucket_spent, bucket_opens, _) in self._buckets.pop(bucket_hour).items():
+                spent[user_id] = spent.get(user_id, 0) - bucket_spent
+                opens[user_id] = opens.get(user_id, 0) - bucket_opens
+                touched.add(user_id)
+        for user_id in touched:
+            drop = max((bucket[user_id][2] for bucket in self._buckets.values() if user_id in bucket), default=0)
+            if opens[user_id] <= 0:
+                spent.pop(user_id, None)
+                opens.pop(user_id, None)
+                best_drop.pop(user_id, None)
+            elif drop > 0:
+                best_drop[user_id] = drop
+            else:
+                best_drop.pop(user_id, None)
+        for board in self.boards.values():
+            board.rebuild()
+
+class Leaderboards:
+    """Топы по тратам, открытиям и лучшему дропу за всё время, сутки и неделю в памяти процесса.
+    Обновляются на каждом открытии, при запуске восстанавливаются из OpeningHistory"""
+    WINDOWS = {'all': None, 'day': 24, 'week': 24 * 7}
+    
+    def __init__(self, size: int = LEADERBOARD_SIZE):
+        self.size = size
+        self.windows = {name: LeaderboardWindow(hours, size) for name, hours in self.WINDOWS.items()}
+        self.names: Dict[int, str] = {}
+    
+    def _advance(self, hour: int):
+        for window in self.windows.values():
+            window.advance(hour)
+    
+    def record(self, user_id: int, spent: int, opens: int, best_drop: int, at: Optional[datetime] = None):
+        hour = _hour_index(at or datetime.utcnow())
+        self._advance(hour)
+        for window in self.windows.values():
+            window.add(hour, user_id, spent, opens, best_drop)
+    
+    def set_name(self, user_id: int, username: Optional[str], first_name: Optional[str]):
+        name = username or first_name
+        if name:
+            self.names[user_id] = name
+    
+    def top(self, board: str, window: str = 'all', limit: int = 10) -> List[dict]:
+        self._advance(_hour_index(datetime.utcnow()))
+        return [
+            {'rank': rank, 'user_id': user_id, 'name': self.names.get(user_id), 'score': score}
+            for rank, (user_id, score) in enumerate(self.windows[window].boards[board].top(limit), start=1)
+        ]
+    
+    async def arebuild(self, db: AsyncSession, chunk_size: int = 10_000):
+        """Пересборка из истории: всё время — агрегатом по пользователям, неделя — потоком строк за 7 дней"""
+        now = datetime.utcnow()
+        windows = {name: LeaderboardWindow(hours, self.size) for name, hours in self.WINDOWS.items()}
+        hour = _hour_index(now)
+        for window in windows.values():
+            window.advance(hour)
+        
+        totals = await db.stream(
+            select(
+                OpeningHistory.user_id,
+                func.sum(OpeningHistory.stars_spent),
+                func.count(OpeningHistory.id),
+                func.max(NFT.price)
+            ).join(NFT, OpeningHistory.nft_id == NFT.id).group_by(OpeningHistory.user_id).execution_options(yield_per=chunk_size)
+        )
+        async for user_id, spent, opens, best_drop in totals:
+            windows['all'].add(hour, user_id, spent, opens, best_drop)
+        
+        recent = await db.stream(
+            select(
+                OpeningHistory.user_id,
+                OpeningHistory.created_at,
+                OpeningHistory.stars_spent,
+                NFT.price
+            ).join(NFT, OpeningHistory.nft_id == NFT.id).where(
+                OpeningHistory.created_at > now - timedelta(hours=self.WINDOWS['week'])
+            ).execution_options(yield_per=chunk_size)
+        )
+        async for user_id, created_at, spent, price in recent:
+            created_hour = _hour_index(created_at)
+            windows['week'].add(created_hour, user_id, spent, 1, price)
+            windows['day'].add(created_hour, user_id, spent, 1, price)
+        
+        names = await db.stream(
+            select(User.id, User.username, User.first_name).where(User.total_cases_opened > 0).execution_options(yield_per=chunk_size)
+        )
+        async for user_id, username, first_name in names:
+            self.set_name(user_id, username, first_name)
+        self.windows = windows
+
+leaderboards = Leaderboards()
+
+def _after_open_commit(history: Optional[HistoryBuffer], rows: List[dict], user_id: int, case_id: int,
+                       odds_hash: str, price: int, nfts: List[dict]):
+    """Побочные эффекты закоммиченного открытия: строки истории в буфер, топы и телеметрия выпадений.
+    Звёзды уже списаны и NFT выданы, поэтому сбой любого из них только логируется и не ломает ответ"""
+    if history is not None:
+        try:
+            history.add(rows)
+        except Exception as e:
+            logger.exception(f"Failed to buffer {len(rows)} opening history rows: {e}; rows: {rows}")
+    try:
+        leaderboards.record(user_id, price * len(nfts), len(nfts), max(nft['price'] for nft in nfts))
+    except Exception as e:
+        logger.exception(f"Failed to update leaderboards for user {user_id}: {e}")
+    try:
+        drop_telemetry.record_many(case_id, odds_hash, [nft['id'] for nft in nfts])
+    except Exception as e:
+        logger.exception(f"Failed to record drops of case {case_id}: {e}")
+
+# Построители запросов общие для синхронных и асинхронных сервисов и для check_query_plans,
+# поэтому EXPLAIN проверяет ровно те запросы, которые выполняются
+def _case_nfts_query(case_id: int):
+    return select(CaseNFT.chance, NFT).join(
+        NFT, CaseNFT.nft_id == NFT.id
+    ).where(
+        CaseNFT.case_id == case_id,
+        CaseNFT.is_active == True,
+        NFT.is_active == True
+    )
+
+def _case_nfts_from_rows(rows) -> List[dict]:
+    return [
+        {
+            'id': nft.id,
+            'name': nft.name,
+            'description': nft.description,
+            'rarity': nft.rarity,
+            'price': nft.price,
+            'image_url': nft.image_url,
+            'chance': chance
+        }
+        for chance, nft in rows
+    ]
+
 class CaseService:
+    # Скомпилированные семплеры по case_id, сбрасываются при изменении шансов
+    _samplers: Dict[int, CaseSampler] = {}
+    
+    @staticmethod
+    def get_sampler(case_id: int, case_nfts: List[dict]) -> CaseSampler:
+        sampler = CaseService._samplers.get(case_id)
+        if sampler is None:
+            sampler = CaseSampler(case_nfts)
+            CaseService._samplers[case_id] = sampler
+        return sampler
+    
+    @staticmethod
+    def invalidate_sampler(case_id: Optional[int] = None):
+        """Сброс семплера кейса (или всех семплеров, если case_id не указан)"""
+        if case_id is None:
+            CaseService._samplers.clear()
+        else:
+            CaseService._samplers.pop(case_id, None)
+    
     @staticmethod
-    def open_case(case_nfts: List[dict]) -> dict:
+    def open_case(case_nfts: List[dict], case_id: Optional[int] = None) -> dict:
         """Открытие кейса с учетом шансов выпадения"""
         if not case_nfts:
             return None
         
+        if case_id is not None:
+            sampler = CaseService.get_sampler(case_id, case_nfts)
+            selected = sampler.sample()
+            drop_telemetry.record(case_id, sampler.odds_hash, selected['id'])
+            return selected
+        
         items = []
         weights = []
         for item in case_nfts:
@@ -168,48 +1467,258 @@ class CaseService:
         selected = random.choices(items, weights=weights, k=1)[0]
         return selected
     
+    @staticmethod
+    def get_catalog_entry(db: Session, case_id: int) -> 'CatalogEntry':
+        """Кейс из кэша каталога: NFT, семплер и готовый JSON"""
+        return case_catalog.get(db, case_id)
+    
     @staticmethod
     def get_case_nfts(db: Session, case_id: int):
-        """Получение всех NFT в кейсе с шансами"""
-        case_nfts = db.query(
-            CaseNFT, NFT
-        ).join(
-            NFT, CaseNFT.nft_id == NFT.id
-        ).filter(
-            CaseNFT.case_id == case_id,
-            CaseNFT.is_active == True,
-            NFT.is_active == True
-        ).all()
-        
-        result = []
-        for case_nft, nft in case_nfts:
-            result.append({
-                'id': nft.id,
-                'name': nft.name,
-                'description': nft.description,
-                'rarity': nft.rarity,
-                'price': nft.price,
-                'image_url': nft.image_url,
-                'chance': case_nft.chance
-            })
+        """Получение всех NFT в кейсе с шансами (из кэша каталога)"""
+        return case_catalog.get(db, case_id).nfts
+    
+    @staticmethod
+    def load_case_nfts(db: Session, case_id: int):
+        """Загрузка NFT кейса с шансами напрямую из базы"""
+        return _case_nfts_from_rows(db.execute(_case_nfts_query(case_id)).all())
+    
+    @staticmethod
+    def open_case_transaction(db: Session, user_id: int, case_id: int, history: Optional[HistoryBuffer] = None) -> Optional[dict]:
+        """Открытие кейса одной транзакцией: списание, NFT в инвентарь, история и счётчики.
+        С history строка истории пишется после commit через буфер, а не в транзакции открытия"""
+        entry = case_catalog.get(db, case_id)
+        if not _is_openable(entry):
+            return None
         
-        return result
+        price = entry.case['price_stars']
+        charged = db.execute(_charge_for_open(user_id, price)).one_or_none()
+        if charged is None:
+            db.rollback()
+            raise InsufficientBalanceError(f"User {user_id} cannot pay {price} stars")
+        
+        seed_id, seeds, first_nonce = FairnessService.reserve(db, user_id, charged)
+        (nft, nonce, roll), = FairnessService.draw(entry.sampler, seeds, first_nonce)
+        user_nft = UserNFT(user_id=user_id, nft_id=nft['id'], opened_from_case_id=case_id)
+        db.add(user_nft)
+        # id берётся до commit: SessionLocal истекает объекты при commit, и чтение после него — лишний SELECT
+        db.flush()
+        user_nft_id = user_nft.id
+        db.execute(_inventory_delta_statement(db.get_bind().dialect.name, user_id, _opened_inventory_deltas([nft])))
+        row = _history_row(user_id, case_id, nft['id'], price, seed_id, nonce, roll, entry.sampler.odds_hash, datetime.utcnow())
+        if history is None:
+            db.add(OpeningHistory(**row))
+        if not entry.sampler.snapshot_saved:
+            db.execute(_odds_snapshot_statement(db.get_bind().dialect.name, case_id, entry.sampler))
+        db.commit()
+        entry.sampler.snapshot_saved = True
+        _after_open_commit(history, [row], user_id, case_id, entry.sampler.odds_hash, price, [nft])
+        return {'nft': nft, 'user_nft_id': user_nft_id, 'balance': charged.stars_balance}
+
+class CatalogEntry:
+    """Снимок кейса: строки NFT, семплер и сериализованный JSON для Mini App"""
+    __slots__ = ('version', 'case', 'nfts', 'sampler', 'payload')
+    
+    def __init__(self, version: int, case: Optional[dict], nfts: List[dict], sampler: Optional[CaseSampler], payload: Optional[bytes]):
+        self.version = version
+        self.case = case
+        self.nfts = nfts
+        self.sampler = sampler
+        self.payload = payload
+
+class CaseCatalog:
+    """Кэш каталога кейсов в памяти процесса с инвалидацией по номеру версии"""
+    
+    def __init__(self):
+        self.version = 0
+        self._entries: Dict[int, CatalogEntry] = {}
+        # (версия, JSON списка активных кейсов, ETag) для /api/cases
+        self._cases_payload: Optional[tuple] = None
+    
+    def bump(self):
+        """Новая версия каталога: все записи и семплеры будут пересобраны"""
+        self.version += 1
+        self._entries.clear()
+        self._cases_payload = None
+        CaseService.invalidate_sampler()
+    
+    async def acases_payload(self, db: AsyncSession) -> tuple:
+        """Готовый JSON списка активных кейсов с NFT и шансами и его ETag"""
+        cached = self._cases_payload
+        if cached is not None and cached[0] == self.version:
+            return cached[1], cached[2]
+        
+        version = self.version
+        case_ids = (await db.execute(
+            select(Case.id).where(Case.is_active == True).order_by(Case.id)
+        )).scalars().all()
+        payloads = []
+        for case_id in case_ids:
+            entry = await self.aget(db, case_id)
+            if entry.payload is not None:
+                payloads.append(entry.payload)
+        
+        # Записи каталога уже сериализованы, список собирается склейкой байтов
+        body = b"[" + b",".join(payloads) + b"]"
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        if version == self.version:
+            self._cases_payload = (version, body, etag)
+        return body, etag
+    
+    def peek(self, case_id: int) -> Optional[CatalogEntry]:
+        entry = self._entries.get(case_id)
+        if entry is not None and entry.version == self.version:
+            return entry
+        return None
+    
+    def get(self, db: Session, case_id: int) -> CatalogEntry:
+        entry = self.peek(case_id)
+        if entry is None:
+            entry = self._build(db, case_id)
+        return entry
+    
+    async def aget(self, db: AsyncSession, case_id: int) -> CatalogEntry:
+        entry = self.peek(case_id)
+        if entry is None:
+            version = self.version
+            case = await db.get(Case, case_id)
+            nfts = await AsyncCaseService.load_case_nfts(db, case_id)
+            entry = self._store(version, case_id, case, nfts)
+        return entry
+    
+    def _build(self, db: Session, case_id: int) -> CatalogEntry:
+        version = self.version
+        case = db.query(Case).filter(Case.id == case_id).first()
+        nfts = CaseService.load_case_nfts(db, case_id)
+        return self._store(version, case_id, case, nfts)
+    
+    def _store(self, version: int, case_id: int, case: Optional[Case], nfts: List[dict]) -> CatalogEntry:
+        CaseService.invalidate_sampler(case_id)
+        try:
+            sampler = CaseService.get_sampler(case_id, nfts) if nfts else None
+        except ValueError:
+            # Все шансы нулевые — open_case упадёт так же, как random.choices
+            sampler = None
+        
+        case_data = None
+        payload = None
+        if case is not None:
+            case_data = {
+                'id': case.id,
+                'name': case.name,
+                'description': case.description,
+                'price_stars': case.price_stars,
+                'image_url': case.image_url,
+                'is_active': case.is_active,
+            }
+            public = {key: value for key, value in case_data.items() if key != 'is_active'}
+            payload = orjson.dumps({**public, 'nfts': nfts})
+        
+        entry = CatalogEntry(version, case_data, nfts, sampler, payload)
+        if case is None:
+            # Несуществующие id не кэшируются: иначе любой запрос с выдуманным case_id растил бы _entries
+            CaseService.invalidate_sampler(case_id)
+        elif version == self.version:
+            self._entries[case_id] = entry
+        else:
+            # Каталог изменился во время сборки, не кэшируем устаревшие данные
+            CaseService.invalidate_sampler(case_id)
+        return entry
+
+case_catalog = CaseCatalog()
+
+def _user_id_query(telegram_id: int):
+    return select(User.id).where(User.telegram_id == telegram_id)
+
+def _user_nfts_query(user_id: int):
+    return select(UserNFT, NFT).join(
+        NFT, UserNFT.nft_id == NFT.id
+    ).where(
+        UserNFT.user_id == user_id,
+        UserNFT.is_sold == False
+    )
+
+def _unsold_user_nft_query(user_nft_id: int, user_id: int):
+    return select(UserNFT).where(
+        UserNFT.id == user_nft_id,
+        UserNFT.user_id == user_id,
+        UserNFT.is_sold == False
+    )
+
+def _inventory_page_query(user_id: int, limit: int, after: Optional[tuple] = None, rarity: Optional[str] = None, nft_id: Optional[int] = None):
+    """Страница непроданного инвентаря (новые сверху), keyset по (created_at, id)"""
+    query = select(
+        UserNFT.id,
+        UserNFT.created_at,
+        NFT.id.label('nft_id'),
+        NFT.name,
+        NFT.rarity,
+        NFT.price,
+        NFT.image_url
+    ).join(
+        NFT, UserNFT.nft_id == NFT.id
+    ).where(
+        UserNFT.user_id == user_id,
+        UserNFT.is_sold == False
+    )
+    if after is not None:
+        created_at, last_id = after
+        query = query.where(or_(
+            UserNFT.created_at < created_at,
+            and_(UserNFT.created_at == created_at, UserNFT.id < last_id)
+        ))
+    if rarity is not None:
+        # Не покрыт индексом: при редкой rarity страница просматривает весь непроданный инвентарь пользователя
+        query = query.where(NFT.rarity == rarity)
+    if nft_id is not None:
+        query = query.where(UserNFT.nft_id == nft_id)
+    return query.order_by(UserNFT.created_at.desc(), UserNFT.id.desc()).limit(limit)
+
+def _create_user_statement(dialect_name: str, telegram_id: int, username: str, first_name: str, last_name: str):
+    """INSERT ... ON CONFLICT DO NOTHING RETURNING id: параллельная регистрация не падает с IntegrityError"""
+    dialect_insert = postgresql_insert if dialect_name == 'postgresql' else sqlite_insert
+    return dialect_insert(User).values(
+        telegram_id=telegram_id,
+        username=username,
+        first_name=first_name,
+        last_name=last_name,
+        stars_balance=1000  # Начальный баланс для теста
+    ).on_conflict_do_nothing(index_elements=[User.telegram_id]).returning(User.id)
 
 class UserService:
+    # Горячий кэш telegram_id -> User.id со счётчиками попаданий
+    _user_ids = LRUCache(USER_CACHE_SIZE)
+    
     @staticmethod
-    def get_or_create_user(db: Session, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None):
-        user = db.query(User).filter(User.telegram_id == telegram_id).first()
-        if not user:
-            user = User(
-                telegram_id=telegram_id,
-                username=username,
-                first_name=first_name,
-                last_name=last_name,
-                stars_balance=1000  # Начальный баланс для теста
-            )
-            db.add(user)
+    def user_cache_stats() -> dict:
+        return UserService._user_ids.stats()
+    
+    @staticmethod
+    def get_or_create_user_id(db: Session, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None) -> int:
+        user_id = UserService._user_ids.get(telegram_id)
+        if user_id is not None:
+            return user_id
+        
+        user_id = db.execute(_user_id_query(telegram_id)).scalar_one_or_none()
+        if user_id is None:
+            statement = _create_user_statement(db.get_bind().dialect.name, telegram_id, username, first_name, last_name)
+            user_id = db.execute(statement).scalar_one_or_none()
+            if user_id is None:
+                # Пользователя только что создал параллельный запрос
+                user_id = db.execute(_user_id_query(telegram_id)).scalar_one()
+            elif PROVABLY_FAIR:
+                FairnessService.first_seed(db, user_id)
             db.commit()
-            db.refresh(user)
+        
+        UserService._user_ids.set(telegram_id, user_id)
+        return user_id
+    
+    @staticmethod
+    def get_or_create_user(db: Session, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        user = db.get(User, UserService.get_or_create_user_id(db, telegram_id, username, first_name, last_name))
+        if user is None:
+            # Пользователь удалён, а id остался в кэше
+            UserService._user_ids.pop(telegram_id)
+            user = db.get(User, UserService.get_or_create_user_id(db, telegram_id, username, first_name, last_name))
         return user
     
     @staticmethod
@@ -220,27 +1729,18 @@ class UserService:
             opened_from_case_id=case_id
         )
         db.add(user_nft)
+        nft = db.get(NFT, nft_id)
+        db.execute(_inventory_delta_statement(db.get_bind().dialect.name, user_id, _opened_inventory_deltas([{'rarity': nft.rarity, 'price': nft.price}])))
         db.commit()
         return user_nft
     
     @staticmethod
     def get_user_nfts(db: Session, user_id: int):
-        return db.query(
-            UserNFT, NFT
-        ).join(
-            NFT, UserNFT.nft_id == NFT.id
-        ).filter(
-            UserNFT.user_id == user_id,
-            UserNFT.is_sold == False
-        ).all()
+        return db.execute(_user_nfts_query(user_id)).all()
     
     @staticmethod
     def sell_nft(db: Session, user_nft_id: int, user_id: int):
-        user_nft = db.query(UserNFT).filter(
-            UserNFT.id == user_nft_id,
-            UserNFT.user_id == user_id,
-            UserNFT.is_sold == False
-        ).first()
+        user_nft = db.execute(_unsold_user_nft_query(user_nft_id, user_id)).scalars().first()
         
         if not user_nft:
             return None
@@ -253,60 +1753,1532 @@ class UserService:
         
         user = db.query(User).filter(User.id == user_id).first()
         user.stars_balance += sell_price
+        # Сводка после users и user_nfts — тот же порядок блокировок, что при открытии
+        db.flush()
+        db.execute(_inventory_delta_statement(db.get_bind().dialect.name, user_id, {nft.rarity: [-1, -sell_price]}))
         
         db.commit()
         return sell_price
+    
+    @staticmethod
+    def sell_nfts(db: Session, user_id: int, user_nft_ids: Optional[List[int]] = None, rarity: Optional[str] = None, nft_id: Optional[int] = None) -> Optional[dict]:
+        """Массовая продажа одной транзакцией: один UPDATE ... FROM nfts ... RETURNING и одно начисление; None, если пользователя нет"""
+        dialect_name = db.get_bind().dialect.name
+        sold = db.execute(_bulk_sell_statement(dialect_name, user_id, user_nft_ids, rarity, nft_id)).all()
+        total = sum(price for _, price, _ in sold)
+        balance = db.execute(_credit_balance(user_id, total)).scalar_one_or_none()
+        if balance is None:
+            # Пользователя нет: у него не может быть и NFT, но транзакцию всё равно откатываем
+            db.rollback()
+            return None
+        if sold:
+            rarities = dict(db.execute(select(NFT.id, NFT.rarity).where(NFT.id.in_({row[2] for row in sold}))).all())
+            db.execute(_inventory_delta_statement(dialect_name, user_id, _sold_inventory_deltas(sold, rarities)))
+        db.commit()
+        return {'sold': [[user_nft_id, price] for user_nft_id, price, _ in sold], 'total': total, 'balance': balance}
+    
+    @staticmethod
+    def get_profile(db: Session, user_id: int) -> Optional[dict]:
+        """Баланс и сводка инвентаря по редкостям: строка users и строки сводки по первичному ключу"""
+        return _profile_from_rows(db.execute(_profile_query(user_id)).all())
+
+def _bulk_sell_statement(dialect_name: str, user_id: int, user_nft_ids: Optional[List[int]], rarity: Optional[str], nft_id: Optional[int]):
+    """UPDATE user_nfts ... FROM nfts: цена продажи считается в базе так же, как int(price * SELL_PERCENT)"""
+    statement = update(UserNFT).where(
+        UserNFT.nft_id == NFT.id,
+        UserNFT.user_id == user_id,
+        UserNFT.is_sold == False
+    )
+    if user_nft_ids is not None:
+        statement = statement.where(UserNFT.id.in_(user_nft_ids))
+    if rarity is not None:
+        statement = statement.where(NFT.rarity == rarity)
+    if nft_id is not None:
+        statement = statement.where(UserNFT.nft_id == nft_id)
+    
+    return statement.values(
+        is_sold=True,
+        sold_price=_sell_price_expression(dialect_name)
+    ).returning(UserNFT.id, UserNFT.sold_price, UserNFT.nft_id).execution_options(synchronize_session=False)
+
+def _credit_balance(user_id: int, amount: int):
+    return update(User).where(User.id == user_id).values(
+        stars_balance=User.stars_balance + amount
+    ).returning(User.stars_balance).execution_options(synchronize_session=False)
+
+class AsyncCaseService:
+    """Асинхронные версии методов CaseService для AsyncSession"""
+    # Выбор NFT не обращается к базе, поэтому общий с синхронным сервисом
+    open_case = staticmethod(CaseService.open_case)
+    get_sampler = staticmethod(CaseService.get_sampler)
+    invalidate_sampler = staticmethod(CaseService.invalidate_sampler)
+    
+    @staticmethod
+    async def get_catalog_entry(db: AsyncSession, case_id: int) -> CatalogEntry:
+        return await case_catalog.aget(db, case_id)
+    
+    @staticmethod
+    async def get_case_nfts(db: AsyncSession, case_id: int):
+        return (await case_catalog.aget(db, case_id)).nfts
+    
+    @staticmethod
+    async def load_case_nfts(db: AsyncSession, case_id: int):
+        return _case_nfts_from_rows((await db.execute(_case_nfts_query(case_id))).all())
+    
+    @staticmethod
+    async def open_case_transaction(db: AsyncSession, user_id: int, case_id: int, history: Optional[HistoryBuffer] = None) -> Optional[dict]:
+        entry = await case_catalog.aget(db, case_id)
+        if not _is_openable(entry):
+            return None
+        
+        price = entry.case['price_stars']
+        charged = (await db.execute(_charge_for_open(user_id, price))).one_or_none()
+        if charged is None:
+            await db.rollback()
+            raise InsufficientBalanceError(f"User {user_id} cannot pay {price} stars")
+        
+        seed_id, seeds, first_nonce = await FairnessService.areserve(db, user_id, charged)
+        (nft, nonce, roll), = FairnessService.draw(entry.sampler, seeds, first_nonce)
+        user_nft = UserNFT(user_id=user_id, nft_id=nft['id'], opened_from_case_id=case_id)
+        db.add(user_nft)
+        await db.execute(_inventory_delta_statement(db.get_bind().dialect.name, user_id, _opened_inventory_deltas([nft])))
+        row = _history_row(user_id, case_id, nft['id'], price, seed_id, nonce, roll, entry.sampler.odds_hash, datetime.utcnow())
+        if history is None:
+            db.add(OpeningHistory(**row))
+        if not entry.sampler.snapshot_saved:
+            await db.execute(_odds_snapshot_statement(db.get_bind().dialect.name, case_id, entry.sampler))
+        await db.commit()
+        entry.sampler.snapshot_saved = True
+        _after_open_commit(history, [row], user_id, case_id, entry.sampler.odds_hash, price, [nft])
+        return {'nft': nft, 'user_nft_id': user_nft.id, 'balance': charged.stars_balance}
+    
+    @staticmethod
+    async def open_cases_transaction(db: AsyncSession, user_id: int, case_id: int, count: int, history: Optional[HistoryBuffer] = None) -> Optional[dict]:
+        """Открытие count кейсов: одно списание и по одной пакетной вставке в UserNFT и OpeningHistory
+        (с history — в OpeningHistory через буфер после commit)"""
+        entry = await case_catalog.aget(db, case_id)
+        if not _is_openable(entry):
+            return None
+        
+        price = entry.case['price_stars']
+        charged = (await db.execute(_charge_for_open(user_id, price, count))).one_or_none()
+        if charged is None:
+            await db.rollback()
+            raise InsufficientBalanceError(f"User {user_id} cannot pay {price * count} stars")
+        
+        seed_id, seeds, first_nonce = await FairnessService.areserve(db, user_id, charged, count)
+        draws = FairnessService.draw(entry.sampler, seeds, first_nonce, count)
+        nft_ids = [nft['id'] for nft, _, _ in draws]
+        now = datetime.utcnow()
+        user_nft_ids = (await db.execute(
+            insert(UserNFT).returning(UserNFT.id, sort_by_parameter_order=True),
+            [
+                {'user_id': user_id, 'nft_id': nft_id, 'opened_from_case_id': case_id, 'created_at': now}
+                for nft_id in nft_ids
+            ]
+        )).scalars().all()
+        await db.execute(_inventory_delta_statement(
+            db.get_bind().dialect.name, user_id, _opened_inventory_deltas(nft for nft, _, _ in draws)
+        ))
+        rows = [
+            _history_row(user_id, case_id, nft['id'], price, seed_id, nonce, roll, entry.sampler.odds_hash, now)
+            for nft, nonce, roll in draws
+        ]
+        if history is None:
+            await db.execute(insert(OpeningHistory), rows)
+        if not entry.sampler.snapshot_saved:
+            await db.execute(_odds_snapshot_statement(db.get_bind().dialect.name, case_id, entry.sampler))
+        await db.commit()
+        entry.sampler.snapshot_saved = True
+        _after_open_commit(history, rows, user_id, case_id, entry.sampler.odds_hash, price, [nft for nft, _, _ in draws])
+        return {'nft_ids': nft_ids, 'user_nft_ids': list(user_nft_ids), 'balance': charged.stars_balance}
+
+class AsyncUserService:
+    """Асинхронные версии методов UserService для AsyncSession"""
+    
+    user_cache_stats = staticmethod(UserService.user_cache_stats)
+    
+    @staticmethod
+    async def get_or_create_user_id(db: AsyncSession, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None) -> int:
+        user_id = UserService._user_ids.get(telegram_id)
+        if user_id is not None:
+            return user_id
+        
+        user_id = (await db.execute(_user_id_query(telegram_id))).scalar_one_or_none()
+        if user_id is None:
+            statement = _create_user_statement(db.get_bind().dialect.name, telegram_id, username, first_name, last_name)
+            user_id = (await db.execute(statement)).scalar_one_or_none()
+            if user_id is None:
+                # Пользователя только что создал параллельный запрос
+                user_id = (await db.execute(_user_id_query(telegram_id))).scalar_one()
+            elif PROVABLY_FAIR:
+                await FairnessService.afirst_seed(db, user_id)
+            await db.commit()
+        
+        UserService._user_ids.set(telegram_id, user_id)
+        return user_id
+    
+    @staticmethod
+    async def get_or_create_user(db: AsyncSession, telegram_id: int, username: str = None, first_name: str = None, last_name: str = None):
+        user = await db.get(User, await AsyncUserService.get_or_create_user_id(db, telegram_id, username, first_name, last_name))
+        if user is None:
+            # Пользователь удалён, а id остался в кэше
+            UserService._user_ids.pop(telegram_id)
+            user = await db.get(User, await AsyncUserService.get_or_create_user_id(db, telegram_id, username, first_name, last_name))
+        return user
+    
+    @staticmethod
+    async def add_nft_to_inventory(db: AsyncSession, user_id: int, nft_id: int, case_id: int):
+        user_nft = UserNFT(
+            user_id=user_id,
+            nft_id=nft_id,
+            opened_from_case_id=case_id
+        )
+        db.add(user_nft)
+        nft = await db.get(NFT, nft_id)
+        await db.execute(_inventory_delta_statement(db.get_bind().dialect.name, user_id, _opened_inventory_deltas([{'rarity': nft.rarity, 'price': nft.price}])))
+        await db.commit()
+        return user_nft
+    
+    @staticmethod
+    async def get_user_nfts(db: AsyncSession, user_id: int):
+        return (await db.execute(_user_nfts_query(user_id))).all()
+    
+    @staticmethod
+    async def get_user_nfts_page(
+        db: AsyncSession,
+        user_id: int,
+        limit: int,
+        after: Optional[tuple] = None,
+        rarity: Optional[str] = None,
+        nft_id: Optional[int] = None
+    ) -> List[dict]:
+        """Страница непроданного инвентаря (новые сверху), keyset по (created_at, id)"""
+        query = _inventory_page_query(user_id, limit, after, rarity, nft_id)
+        return [dict(row._mapping) for row in (await db.execute(query)).all()]
+    
+    @staticmethod
+    async def sell_nft(db: AsyncSession, user_nft_id: int, user_id: int):
+        user_nft = (await db.execute(_unsold_user_nft_query(user_nft_id, user_id))).scalar_one_or_none()
+        
+        if not user_nft:
+            return None
+        
+        nft = await db.get(NFT, user_nft.nft_id)
+        sell_price = int(nft.price * SELL_PERCENT)
+        
+        user_nft.is_sold = True
+        user_nft.sold_price = sell_price
+        
+        user = await db.get(User, user_id)
+        user.stars_balance += sell_price
+        await db.flush()
+        await db.execute(_inventory_delta_statement(db.get_bind().dialect.name, user_id, {nft.rarity: [-1, -sell_price]}))
+        
+        await db.commit()
+        return sell_price
+    
+    @staticmethod
+    async def sell_nfts(db: AsyncSession, user_id: int, user_nft_ids: Optional[List[int]] = None, rarity: Optional[str] = None, nft_id: Optional[int] = None) -> Optional[dict]:
+        dialect_name = db.get_bind().dialect.name
+        sold = (await db.execute(_bulk_sell_statement(dialect_name, user_id, user_nft_ids, rarity, nft_id))).all()
+        total = sum(price for _, price, _ in sold)
+        balance = (await db.execute(_credit_balance(user_id, total))).scalar_one_or_none()
+        if balance is None:
+            await db.rollback()
+            return None
+        if sold:
+            rarities = dict((await db.execute(select(NFT.id, NFT.rarity).where(NFT.id.in_({row[2] for row in sold})))).all())
+            await db.execute(_inventory_delta_statement(dialect_name, user_id, _sold_inventory_deltas(sold, rarities)))
+        await db.commit()
+        return {'sold': [[user_nft_id, price] for user_nft_id, price, _ in sold], 'total': total, 'balance': balance}
+    
+    @staticmethod
+    async def get_profile(db: AsyncSession, user_id: int) -> Optional[dict]:
+        return _profile_from_rows((await db.execute(_profile_query(user_id))).all())
+
+async def get_async_db():
+    """FastAPI-зависимость: асинхронная сессия на время запроса"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Выгрузка истории открытий для аналитики
+EXPORT_COLUMNS = (
+    'id', 'created_at', 'user_id', 'telegram_id', 'username', 'case_id', 'case_name',
+    'nft_id', 'nft_name', 'rarity', 'nft_price', 'stars_spent', 'seed_id', 'nonce', 'roll'
+)
+EXPORT_FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def _export_query(start: Optional[datetime] = None, end: Optional[datetime] = None, case_ids: Optional[List[int]] = None,
+                  after: Optional[tuple] = None):
+    """Выгрузка в порядке (created_at, id) — порядке ix_opening_history_created; after — (created_at, id) последней полученной строки"""
+    query = select(
+        OpeningHistory.id,
+        OpeningHistory.created_at,
+        OpeningHistory.user_id,
+        User.telegram_id,
+        User.username,
+        OpeningHistory.case_id,
+        Case.name,
+        OpeningHistory.nft_id,
+        NFT.name,
+        NFT.rarity,
+        NFT.price,
+        OpeningHistory.stars_spent,
+        OpeningHistory.seed_id,
+        OpeningHistory.nonce,
+        OpeningHistory.roll
+    ).outerjoin(
+        User, OpeningHistory.user_id == User.id
+    ).outerjoin(
+        Case, OpeningHistory.case_id == Case.id
+    ).outerjoin(
+        NFT, OpeningHistory.nft_id == NFT.id
+    )
+    if start is not None:
+        query = query.where(OpeningHistory.created_at >= start)
+    if end is not None:
+        query = query.where(OpeningHistory.created_at < end)
+    if case_ids:
+        query = query.where(OpeningHistory.case_id.in_(case_ids))
+    if after is not None:
+        created_at, last_id = after
+        query = query.where(or_(
+            OpeningHistory.created_at > created_at,
+            and_(OpeningHistory.created_at == created_at, OpeningHistory.id > last_id)
+        ))
+    return query.order_by(OpeningHistory.created_at, OpeningHistory.id)
+
+def _encode_export_rows(rows, fmt: str) -> bytes:
+    if fmt == 'ndjson':
+        return b"".join(orjson.dumps(dict(zip(EXPORT_COLUMNS, row))) + b"\n" for row in rows)
+    
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        row = list(row)
+        row[1] = row[1].isoformat() if row[1] is not None else None
+        writer.writerow(row)
+    return buffer.getvalue().encode()
+
+async def export_opening_history(
+    fmt: str = 'ndjson',
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    case_ids: Optional[List[int]] = None,
+    compress: bool = False,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+    session_factory=None,
+    after: Optional[tuple] = None
+):
+    """Поток байтов выгрузки: история читается курсором порциями по chunk_size строк (yield_per),
+    каждая порция сразу кодируется и, если нужно, сжимается gzip — память не зависит от размера выгрузки.
+    Прерванную выгрузку можно продолжить с after = (created_at, id) последней записанной строки.
+    Сессия открывается внутри генератора, потому что ответ стримится уже после выхода из обработчика"""
+    session_factory = session_factory if session_factory is not None else AsyncSessionLocal
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # wbits=31 — формат gzip
+    
+    def emit(data: bytes) -> bytes:
+        return compressor.compress(data) if compressor is not None else data
+    
+    if fmt == 'csv':
+        yield emit((",".join(EXPORT_COLUMNS) + "\r\n").encode())
+    async with session_factory() as db:
+        result = await db.stream(_export_query(start, end, case_ids, after).execution_options(yield_per=chunk_size))
+        async for rows in result.partitions():
+            data = emit(_encode_export_rows(rows, fmt))
+            if data:
+                yield data
+    if compressor is not None:
+        yield compressor.flush()
+
+# Агрегаты статистики открытий
+def _bucket_expression(dialect_name: str, column):
+    """Начало часа для column на стороне базы"""
+    if dialect_name == 'postgresql':
+        return func.date_trunc('hour', column)
+    return func.strftime('%Y-%m-%d %H:00:00', column)
+
+def _as_datetime(value) -> datetime:
+    # SQLite возвращает strftime строкой
+    return datetime.fromisoformat(value) if isinstance(value, str) else value
+
+def _rollup_delta_query(dialect_name: str, start: datetime, end: datetime):
+    """Открытия [start, end) по (час, кейс, редкость)"""
+    bucket = _bucket_expression(dialect_name, OpeningHistory.created_at)
+    return select(
+        bucket,
+        OpeningHistory.case_id,
+        NFT.rarity,
+        func.count(OpeningHistory.id),
+        func.sum(OpeningHistory.stars_spent),
+        func.sum(NFT.price)
+    ).join(
+        NFT, OpeningHistory.nft_id == NFT.id
+    ).where(
+        OpeningHistory.created_at >= start,
+        OpeningHistory.created_at < end
+    ).group_by(bucket, OpeningHistory.case_id, NFT.rarity)
+
+def _stats_upsert_statement(dialect_name: str, model, rows: List[dict]):
+    dialect_insert = postgresql_insert if dialect_name == 'postgresql' else sqlite_insert
+    statement = dialect_insert(model).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=[model.bucket, model.case_id, model.rarity],
+        set_={
+            'opens': model.opens + statement.excluded.opens,
+            'stars_spent': model.stars_spent + statement.excluded.stars_spent,
+            'payout_value': model.payout_value + statement.excluded.payout_value,
+        }
+    )
+
+class StatsRollup:
+    """Компактор агрегатов: раз в interval секунд переносит в opening_stats_hourly и opening_stats_daily
+    историю между водяным знаком и now - lag. Каждый отрезок до span часов — одна транзакция
+    вместе со сдвигом водяного знака, поэтому строка истории попадает в агрегаты ровно один раз"""
+    NAME = "opening_stats"
+    
+    def __init__(self, session_factory=None, interval: int = ROLLUP_INTERVAL, lag: int = ROLLUP_LAG, span_hours: int = ROLLUP_SPAN_HOURS):
+        self.session_factory = session_factory if session_factory is not None else AsyncSessionLocal
+        self.interval = interval
+        self.lag = lag
+        self.span = timedelta(hours=span_hours)
+        self._task: Optional[asyncio.Task] = None
+        self.passes = 0
+        self.failed = 0
+        self.rows_aggregated = 0
+        self.rows_written = 0
+        self.watermark: Optional[datetime] = None
+        self.last_duration = 0.0
+    
+    async def start(self):
+        self._task = asyncio.create_task(self._run(), name="stats-rollup")
+    
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Stats rollup failed: {e}")
+            await asyncio.sleep(self.interval)
+    
+    async def run_once(self, now: Optional[datetime] = None) -> int:
+        """Догоняет водяной знак до now - lag; возвращает число обработанных строк истории"""
+        cutoff = (now or datetime.utcnow()) - timedelta(seconds=self.lag)
+        started = time.perf_counter()
+        total = 0
+        while True:
+            async with self.session_factory() as db:
+                watermark = (await db.execute(
+                    select(RollupWatermark.watermark).where(RollupWatermark.name == self.NAME).with_for_update()
+                )).scalar_one_or_none()
+                if watermark is None:
+                    # Первый проход начинается с самой старой строки истории
+                    watermark = (await db.execute(select(func.min(OpeningHistory.created_at)))).scalar_one_or_none()
+                    watermark = _as_datetime(watermark) if watermark is not None else cutoff
+                if watermark >= cutoff:
+                    self.watermark = watermark
+                    break
+                
+                end = min(cutoff, watermark + self.span)
+                total += await self._compact(db, watermark, end)
+                dialect_insert = postgresql_insert if db.get_bind().dialect.name == 'postgresql' else sqlite_insert
+                statement = dialect_insert(RollupWatermark).values(name=self.NAME, watermark=end)
+                await db.execute(statement.on_conflict_do_update(
+                    index_elements=[RollupWatermark.name],
+                    set_={'watermark': statement.excluded.watermark}
+                ))
+                await db.commit()
+                self.watermark = end
+        
+        self.passes += 1
+        self.rows_aggregated += total
+        self.last_duration = time.perf_counter() - started
+        return total
+    
+    async def _compact(self, db: AsyncSession, start: datetime, end: datetime) -> int:
+        dialect_name = db.get_bind().dialect.name
+        rows = (await db.execute(_rollup_delta_query(dialect_name, start, end))).all()
+        if not rows:
+            return 0
+        
+        hourly = []
+        daily: Dict[tuple, dict] = {}
+        for hour, case_id, rarity, opens, stars_spent, payout_value in rows:
+            hour = _as_datetime(hour)
+            hourly.append({
+                'bucket': hour, 'case_id': case_id, 'rarity': rarity,
+                'opens': opens, 'stars_spent': stars_spent, 'payout_value': payout_value
+            })
+            day = hour.replace(hour=0)
+            stats = daily.setdefault((day, case_id, rarity), {
+                'bucket': day, 'case_id': case_id, 'rarity': rarity, 'opens': 0, 'stars_spent': 0, 'payout_value': 0
+            })
+            stats['opens'] += opens
+            stats['stars_spent'] += stars_spent
+            stats['payout_value'] += payout_value
+        
+        await db.execute(_stats_upsert_statement(dialect_name, OpeningStatsHourly, hourly))
+        await db.execute(_stats_upsert_statement(dialect_name, OpeningStatsDaily, list(daily.values())))
+        self.rows_written += len(hourly) + len(daily)
+        return sum(row[3] for row in rows)
+    
+    def metrics(self) -> dict:
+        return {
+            'passes': self.passes,
+            'failed': self.failed,
+            'rows_aggregated': self.rows_aggregated,
+            'rows_written': self.rows_written,
+            'watermark': self.watermark.isoformat() if self.watermark else None,
+            'last_duration_ms': self.last_duration * 1000,
+        }
+
+stats_rollup = StatsRollup()
+
+def _opening_stats_query(granularity: str = 'day', start: Optional[datetime] = None, end: Optional[datetime] = None, case_ids: Optional[List[int]] = None):
+    model = OpeningStatsHourly if granularity == 'hour' else OpeningStatsDaily
+    query = select(model.bucket, model.case_id, model.rarity, model.opens, model.stars_spent, model.payout_value)
+    if start is not None:
+        query = query.where(model.bucket >= start)
+    if end is not None:
+        query = query.where(model.bucket < end)
+    if case_ids:
+        query = query.where(model.case_id.in_(case_ids))
+    return query.order_by(model.bucket, model.case_id, model.rarity)
+
+async def get_opening_stats(db: AsyncSession, granularity: str = 'day', start: Optional[datetime] = None, end: Optional[datetime] = None, case_ids: Optional[List[int]] = None) -> dict:
+    """Статистика открытий из агрегатов: строки по (bucket, кейс, редкость) и итоги по кейсам и редкостям"""
+    query = _opening_stats_query(granularity, start, end, case_ids)
+    rows = [dict(row._mapping) for row in (await db.execute(query)).all()]
+    
+    by_case: Dict[int, dict] = {}
+    by_rarity: Dict[str, dict] = {}
+    for row in rows:
+        for totals in (by_case.setdefault(row['case_id'], {}), by_rarity.setdefault(row['rarity'], {})):
+            for key in ('opens', 'stars_spent', 'payout_value'):
+                totals[key] = totals.get(key, 0) + row[key]
+    for totals in by_case.values():
+        totals['payout_ratio'] = totals['payout_value'] / totals['stars_spent'] if totals['stars_spent'] else 0.0
+    
+    watermark = (await db.execute(
+        select(RollupWatermark.watermark).where(RollupWatermark.name == StatsRollup.NAME)
+    )).scalar_one_or_none()
+    return {'granularity': granularity, 'watermark': watermark, 'rows': rows, 'by_case': by_case, 'by_rarity': by_rarity}
+
+# Телеметрия выпадений против CaseNFT.chance
+class DropTelemetry:
+    """Счётчики выпадений (case_id, odds_hash, nft_id) в памяти: на открытии — только инкремент в dict.
+    Фоновая задача подменяет словарь целиком и прибавляет накопленное к case_drop_stats одним upsert"""
+    
+    def __init__(self, session_factory=None, interval: int = DROP_STATS_INTERVAL):
+        self.session_factory = session_factory if session_factory is not None else AsyncSessionLocal
+        self.interval = interval
+        self._counts: Dict[tuple, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.recorded = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_ms = 0.0
+    
+    def record(self, case_id: int, odds_hash: str, nft_id: int):
+        key = (case_id, odds_hash, nft_id)
+        counts = self._counts
+        counts[key] = counts.get(key, 0) + 1
+    
+    def record_many(self, case_id: int, odds_hash: str, nft_ids: List[int]):
+        counts = self._counts
+        for nft_id in nft_ids:
+            key = (case_id, odds_hash, nft_id)
+            counts[key] = counts.get(key, 0) + 1
+    
+    def pending(self, case_id: int, odds_hash: str) -> Dict[int, int]:
+        return {key[2]: count for key, count in list(self._counts.items()) if key[0] == case_id and key[1] == odds_hash}
+    
+    async def start(self):
+        self._task = asyncio.create_task(self._run(), name="drop-telemetry")
+    
+    async def stop(self):
+        """Останавливает фоновый сброс и записывает оставшиеся счётчики"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+    
+    async def flush(self) -> int:
+        counts, self._counts = self._counts, {}
+        if not counts:
+            return 0
+        
+        started = time.perf_counter()
+        try:
+            async with self.session_factory() as db:
+                dialect_insert = postgresql_insert if db.get_bind().dialect.name == 'postgresql' else sqlite_insert
+                now = datetime.utcnow()
+                statement = dialect_insert(CaseDropStats).values([
+                    {'case_id': case_id, 'odds_hash': odds_hash, 'nft_id': nft_id, 'drops': drops, 'updated_at': now}
+                    for (case_id, odds_hash, nft_id), drops in counts.items()
+                ])
+                await db.execute(statement.on_conflict_do_update(
+                    index_elements=[CaseDropStats.case_id, CaseDropStats.odds_hash, CaseDropStats.nft_id],
+                    set_={'drops': CaseDropStats.drops + statement.excluded.drops, 'updated_at': statement.excluded.updated_at}
+                ))
+                await db.commit()
+        except Exception as e:
+            # Счётчики возвращаются и уйдут со следующим сбросом
+            self.failed_flushes += 1
+            for key, drops in counts.items():
+                self._counts[key] = self._counts.get(key, 0) + drops
+            logger.exception(f"Drop telemetry flush failed: {e}")
+            return 0
+        
+        self.flushes += 1
+        self.recorded += sum(counts.values())
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        return len(counts)
+    
+    def metrics(self) -> dict:
+        return {
+            'pending_keys': len(self._counts),
+            'flushed_drops': self.recorded,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'last_flush_ms': self.last_flush_ms,
+        }
+
+drop_telemetry = DropTelemetry()
+
+def _drop_counts_query(case_id: int, odds_hash: str):
+    return select(CaseDropStats.nft_id, CaseDropStats.drops).where(
+        CaseDropStats.case_id == case_id,
+        CaseDropStats.odds_hash == odds_hash
+    )
+
+async def get_drop_report(db: AsyncSession, case_ids: Optional[List[int]] = None, alpha: float = DROP_ALERT_P_VALUE) -> List[dict]:
+    """Наблюдаемые и ожидаемые частоты по текущим шансам каждого кейса и p-value хи-квадрат.
+    Учитываются выпадения из case_drop_stats и ещё не сброшенные счётчики этого процесса"""
+    if case_ids is None:
+        case_ids = (await db.execute(select(Case.id).where(Case.is_active == True).order_by(Case.id))).scalars().all()
+    
+    report = []
+    for case_id in case_ids:
+        entry = await case_catalog.aget(db, case_id)
+        if not _is_openable(entry):
+            continue
+        sampler = entry.sampler
+        observed = dict((await db.execute(_drop_counts_query(case_id, sampler.odds_hash))).all())
+        for nft_id, drops in drop_telemetry.pending(case_id, sampler.odds_hash).items():
+            observed[nft_id] = observed.get(nft_id, 0) + drops
+        
+        total_chance = sum(item['chance'] for item in sampler.items)
+        counts = [observed.get(item['id'], 0) for item in sampler.items]
+        probabilities = [item['chance'] / total_chance for item in sampler.items]
+        drops = sum(counts)
+        statistic, dof, p_value = chi_square(counts, probabilities) if drops else (0.0, len(counts) - 1, 1.0)
+        report.append({
+            'case_id': case_id,
+            'odds_hash': sampler.odds_hash,
+            'drops': drops,
+            'chi2': statistic,
+            'dof': dof,
+            'p_value': p_value,
+            # Хи-квадрат надёжен, когда в каждой ячейке ожидается хотя бы 5 выпадений
+            'reliable': drops * min(probabilities) >= 5,
+            'alert': drops > 0 and p_value < alpha,
+            'nfts': [
+                {
+                    'nft_id': item['id'],
+                    'observed': count,
+                    'expected': drops * probability,
+                    'observed_rate': count / drops if drops else 0.0,
+                    'expected_rate': probability,
+                }
+                for item, count, probability in zip(sampler.items, counts, probabilities)
+            ],
+        })
+    return report
+
+# Версия каталога: любые изменения Case, NFT и CaseNFT через ORM поднимают её после commit.
+# Массовые UPDATE в обход ORM должны вызывать case_catalog.bump() сами
+# (а при смене цены или редкости NFT — ещё и rebuild_inventory_summary(connection, nft_ids=...)).
+_CATALOG_MODELS = (Case, NFT, CaseNFT)
+
+@event.listens_for(Session, "after_flush")
+def _collect_catalog_changes(session, flush_context):
+    if session.info.get('catalog_changed'):
+        return
+    for obj in chain(session.new, session.deleted):
+        if isinstance(obj, _CATALOG_MODELS):
+            session.info['catalog_changed'] = True
+            return
+    for obj in session.dirty:
+        if isinstance(obj, _CATALOG_MODELS) and session.is_modified(obj):
+            session.info['catalog_changed'] = True
+            return
+
+@event.listens_for(Session, "after_flush")
+def _refresh_inventory_summary(session, flush_context):
+    # Сводка хранит int(price * SELL_PERCENT) по редкости на момент открытия: после смены цены или
+    # редкости NFT строки его владельцев пересчитываются в той же транзакции, что и сама правка
+    nft_ids = [
+        obj.id for obj in session.dirty
+        if isinstance(obj, NFT) and (
+            attributes.get_history(obj, 'price').has_changes() or attributes.get_history(obj, 'rarity').has_changes()
+        )
+    ]
+    if nft_ids:
+        rebuild_inventory_summary(session.connection(), nft_ids=nft_ids)
+
+@event.listens_for(Session, "after_commit")
+def _bump_catalog_version(session):
+    if session.info.pop('catalog_changed', False):
+        case_catalog.bump()
+
+@event.listens_for(Session, "after_rollback")
+def _discard_catalog_changes(session):
+    session.info.pop('catalog_changed', None)
+
+# Статистика и Monte Carlo симуляция RTP кейсов
+def chi2_sf(statistic: float, dof: int) -> float:
+    """p-value критерия хи-квадрат: регуляризованная верхняя неполная гамма-функция Q(dof/2, x/2)"""
+    if dof <= 0:
+        return 1.0
+    if statistic <= 0:
+        return 1.0
+    a = dof / 2.0
+    x = statistic / 2.0
+    log_prefix = a * math.log(x) - x - math.lgamma(a)
+    if x < a + 1:
+        # Ряд для нижней функции P(a, x)
+        term = total = 1.0 / a
+        n = a
+        for _ in range(10_000):
+            n += 1
+            term *= x / n
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return max(0.0, 1.0 - total * math.exp(log_prefix))
+    # Цепная дробь (метод Лентца) для Q(a, x)
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 10_000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return min(1.0, math.exp(log_prefix) * h)
+
+def chi_square(observed, expected_probabilities) -> tuple:
+    """Хи-квадрат наблюдаемых частот против ожидаемых вероятностей: (статистика, степени свободы, p-value)"""
+    observed = np.asarray(observed, dtype=np.float64)
+    probabilities = np.asarray(expected_probabilities, dtype=np.float64)
+    mask = probabilities > 0
+    expected = probabilities[mask] * observed.sum()
+    statistic = float(((observed[mask] - expected) ** 2 / expected).sum()) if expected.size else 0.0
+    dof = int(mask.sum()) - 1
+    return statistic, dof, chi2_sf(statistic, dof)
+
+def simulate_case(nfts: List[dict], price_stars: int, draws: int = 10_000_000, batch: int = 2_000_000, seed: Optional[int] = None) -> dict:
+    """Monte Carlo открытий кейса пачками (searchsorted по накопленным шансам): EV, RTP, дисперсия, хи-квадрат"""
+    chances = np.array([nft['chance'] for nft in nfts], dtype=np.float64)
+    prices = np.array([nft['price'] for nft in nfts], dtype=np.float64)
+    # Та же цена продажи, что и в UserService.sell_nft
+    sell_values = np.array([int(nft['price'] * SELL_PERCENT) for nft in nfts], dtype=np.float64)
+    cumulative = np.cumsum(chances)
+    total = cumulative[-1]
+    probabilities = chances / total
+    
+    rng = np.random.default_rng(seed)
+    counts = np.zeros(len(nfts), dtype=np.int64)
+    started = time.perf_counter()
+    for offset in range(0, draws, batch):
+        size = min(batch, draws - offset)
+        # side='right': NFT с нулевым шансом никогда не выпадает
+        indexes = np.searchsorted(cumulative, rng.random(size) * total, side='right')
+        counts += np.bincount(indexes, minlength=len(nfts))
+    elapsed = time.perf_counter() - started
+    
+    frequencies = counts / draws
+    ev_price = float(frequencies @ prices)
+    ev_sell = float(frequencies @ sell_values)
+    variance_sell = float(frequencies @ (sell_values - ev_sell) ** 2)
+    statistic, dof, p_value = chi_square(counts, probabilities)
+    return {
+        'draws': draws,
+        'price_stars': price_stars,
+        'ev_price': ev_price,
+        'ev_sell': ev_sell,
+        'rtp': ev_price / price_stars,
+        'rtp_sell': ev_sell / price_stars,
+        'expected_rtp': float(probabilities @ prices) / price_stars,
+        'expected_rtp_sell': float(probabilities @ sell_values) / price_stars,
+        'house_edge': 1 - ev_sell / price_stars,
+        'variance_sell': variance_sell,
+        'std_sell': math.sqrt(variance_sell),
+        'chi2': statistic,
+        'dof': dof,
+        'p_value': p_value,
+        'draws_per_sec': draws / elapsed if elapsed else float('inf'),
+        'counts': {nft['id']: int(count) for nft, count in zip(nfts, counts)},
+    }
+
+def simulate_cases(db: Session, case_ids: Optional[List[int]] = None, draws: int = 10_000_000, seed: Optional[int] = None) -> Dict[int, dict]:
+    """Симуляция по кейсам из каталога (по умолчанию — всем активным)"""
+    if case_ids is None:
+        case_ids = [case_id for case_id, in db.query(Case.id).filter(Case.is_active == True).order_by(Case.id)]
+    results = {}
+    for case_id in case_ids:
+        entry = case_catalog.get(db, case_id)
+        if not _is_openable(entry):
+            continue
+        results[case_id] = {'name': entry.case['name'], **simulate_case(entry.nfts, entry.case['price_stars'], draws, seed=seed)}
+    return results
+
+def _print_simulation(case_id, result: dict):
+    name = f" {result['name']}" if 'name' in result else ""
+    print(f"[{case_id}]{name}: {result['draws']:,} draws at {result['draws_per_sec']:,.0f}/s")
+    print(f"    EV {result['ev_price']:.2f} stars (sell {result['ev_sell']:.2f}) for price {result['price_stars']}")
+    print(f"    RTP {result['rtp']:.4f} (expected {result['expected_rtp']:.4f}), "
+          f"sell RTP {result['rtp_sell']:.4f} (expected {result['expected_rtp_sell']:.4f}), house edge {result['house_edge']:.4f}")
+    print(f"    payout std {result['std_sell']:.2f}, chi2 {result['chi2']:.2f} (dof {result['dof']}), p-value {result['p_value']:.4f}")
+
+def simulation_self_test(draws: int = 10_000_000, alpha: float = 1e-4) -> dict:
+    """Проверка движка на синтетическом кейсе: частоты совпадают с шансами, RTP — с теоретическим"""
+    nfts = [
+        {'id': 1, 'chance': 70.0, 'price': 50},
+        {'id': 2, 'chance': 20.0, 'price': 150},
+        {'id': 3, 'chance': 8.0, 'price': 500},
+        {'id': 4, 'chance': 1.9, 'price': 2500},
+        {'id': 5, 'chance': 0.1, 'price': 25000},
+        {'id': 6, 'chance': 0.0, 'price': 100000},
+    ]
+    result = simulate_case(nfts, price_stars=200, draws=draws, seed=12345)
+    _print_simulation('self-test', result)
+    assert result['counts'][6] == 0, "zero-chance NFT was drawn"
+    assert result['p_value'] > alpha, f"observed frequencies differ from chances (p={result['p_value']:.2e})"
+    # Погрешность RTP: 6 стандартных ошибок среднего
+    tolerance = 6 * result['std_sell'] / math.sqrt(draws) / result['price_stars']
+    assert abs(result['rtp_sell'] - result['expected_rtp_sell']) < tolerance, "simulated RTP differs from expected"
+    return result
+
+def _init_data_hash(init_data: str) -> Optional[str]:
+    """Значение поля hash из init_data без разбора остальных полей"""
+    index = init_data.find('hash=')
+    while index > 0 and init_data[index - 1] != '&':
+        index = init_data.find('hash=', index + 1)
+    if index < 0:
+        return None
+    end = init_data.find('&', index)
+    return init_data[index + 5:end if end >= 0 else None]
+
+class SessionUser:
+    """Пользователь из сессионного токена, без обращения к базе"""
+    __slots__ = ('telegram_id', 'user_id')
+    
+    def __init__(self, telegram_id: int, user_id: int):
+        self.telegram_id = telegram_id
+        self.user_id = user_id
 
 class AuthService:
+    # hash -> проверенная строка init_data, живёт до auth_date + INIT_DATA_MAX_AGE
+    _verified = LRUCache(INIT_DATA_CACHE_SIZE)
+    
     @staticmethod
     def verify_telegram_init_data(init_data: str) -> bool:
-        """Проверка подлинности данных от Telegram"""
+        """Проверка подлинности данных от Telegram: подпись и свежесть auth_date"""
+        hash_value = _init_data_hash(init_data)
+        # Запись в кэше истекает вместе с auth_date + INIT_DATA_MAX_AGE, так что попадание всегда свежее
+        if hash_value and AuthService._verified.get(hash_value) == init_data:
+            return True
+        
+        auth_date = AuthService.check_init_data_signature(init_data, WEBAPP_SECRET_KEY)
+        if not auth_date:
+            # Подпись неверна или auth_date нет: без него нельзя отличить свежие данные от перехваченных
+            return False
+        
+        expires_at = auth_date + INIT_DATA_MAX_AGE
+        if expires_at <= time.time():
+            return False
+        AuthService._verified.set(hash_value, init_data, expires_at)
+        return True
+    
+    @staticmethod
+    def check_init_data_signature(init_data: str, secret_key: bytes) -> Optional[int]:
+        """Полная проверка HMAC без кэша; возвращает auth_date (0, если его нет) или None"""
         try:
             # Парсим данные
             data_pairs = []
             hash_value = None
+            auth_date = 0
             
             for pair in init_data.split('&'):
                 key, value = pair.split('=')
                 if key == 'hash':
                     hash_value = value
                 else:
+                    if key == 'auth_date':
+                        auth_date = int(value)
                     data_pairs.append((key, value))
             
             if not hash_value:
-                return False
+                return None
             
             # Сортируем и формируем строку для проверки
             data_pairs.sort(key=lambda x: x[0])
             data_check_string = '\n'.join(f"{k}={v}" for k, v in data_pairs)
             
-            # Создаем секретный ключ из токена бота
-            secret_key = hashlib.sha256(BOT_TOKEN.encode()).digest()
-            
             # Вычисляем HMAC
             h = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256)
             computed_hash = h.hexdigest()
             
-            return computed_hash == hash_value
+            return auth_date if hmac.compare_digest(computed_hash, hash_value) else None
         except Exception as e:
             logger.error(f"Auth error: {e}")
-            return False
+            return None
+    
+    @staticmethod
+    def issue_session_token(telegram_id: int, user_id: int) -> str:
+        """Короткоживущий подписанный токен сессии Mini App"""
+        claims = {
+            'telegram_id': telegram_id,
+            'user_id': user_id,
+            'exp': int(time.time()) + SESSION_TOKEN_TTL
+        }
+        return jwt.encode(claims, SESSION_TOKEN_SECRET, algorithm=SESSION_TOKEN_ALGORITHM)
+    
+    @staticmethod
+    def decode_session_token(token: str) -> Optional['SessionUser']:
+        """Проверка подписи и срока действия токена; None, если токен недействителен"""
+        try:
+            claims = jwt.decode(token, SESSION_TOKEN_SECRET, algorithms=[SESSION_TOKEN_ALGORITHM])
+            return SessionUser(claims['telegram_id'], claims['user_id'])
+        except (JWTError, KeyError):
+            return None
+    
+    @staticmethod
+    def get_user_data(init_data: str) -> Optional[dict]:
+        """Данные пользователя Telegram из поля user в init_data"""
+        for pair in init_data.split('&'):
+            key, _, value = pair.partition('=')
+            if key == 'user':
+                try:
+                    return json.loads(unquote(value))
+                except ValueError:
+                    return None
+        return None
+
+def _accepted_encodings(accept_encoding: str) -> set:
+    """Кодировки из Accept-Encoding с ненулевым q"""
+    accepted = set()
+    for part in accept_encoding.lower().split(','):
+        coding, _, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding)
+    return accepted
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in (tag.strip() for tag in if_none_match.split(','))
+
+class PrecompressedPage:
+    """HTML, сжатый один раз при запуске: brotli, gzip и исходные байты с ETag на каждый вариант"""
+    
+    ENCODINGS = ('br', 'gzip', 'identity')
+    
+    def __init__(self, html: str, max_age: int = MINI_APP_CACHE_MAX_AGE):
+        raw = html.encode('utf-8')
+        digest = hashlib.sha256(raw).hexdigest()[:32]
+        self.bodies = {
+            'br': brotli.compress(raw, quality=11),
+            'gzip': gzip.compress(raw, compresslevel=9, mtime=0),
+            'identity': raw,
+        }
+        # Сильный ETag должен различаться для разных Content-Encoding
+        self.etags = {encoding: f'"{digest}-{encoding}"' for encoding in self.ENCODINGS}
+        self.cache_control = f"public, max-age={max_age}"
+    
+    def choose_encoding(self, accept_encoding: str) -> str:
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted or '*' in accepted:
+                return encoding
+        return 'identity'
+    
+    def response(self, request: Request) -> Response:
+        encoding = self.choose_encoding(request.headers.get('accept-encoding', ''))
+        etag = self.etags[encoding]
+        headers = {'ETag': etag, 'Cache-Control': self.cache_control, 'Vary': 'Accept-Encoding'}
+        
+        if _etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+        
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        return Response(self.bodies[encoding], media_type="text/html; charset=utf-8", headers=headers)
+
+_mini_app_page: Optional[PrecompressedPage] = None
+
+def get_mini_app_page() -> PrecompressedPage:
+    """Собранная страница Mini App (строится при запуске в lifespan)"""
+    global _mini_app_page
+    if _mini_app_page is None:
+        _mini_app_page = PrecompressedPage(HTML_TEMPLATE)
+    return _mini_app_page
+
+class OutboundHTTP:
+    """Общий aiohttp.TCPConnector для всех исходящих клиентов со статистикой переиспользования соединений"""
+    
+    def __init__(self, limit: int = HTTP_POOL_SIZE, limit_per_host: int = HTTP_POOL_PER_HOST,
+                 keepalive: float = HTTP_KEEPALIVE, dns_ttl: int = HTTP_DNS_TTL):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.dns_ttl = dns_ttl
+        self._connector: Optional[aiohttp.TCPConnector] = None
+        self._trace = aiohttp.TraceConfig()
+        self._trace.on_request_start.append(self._count('requests'))
+        self._trace.on_connection_create_end.append(self._count('connections_created'))
+        self._trace.on_connection_reuseconn.append(self._count('connections_reused'))
+        self._trace.on_connection_queued_start.append(self._count('pool_waits'))
+        self._trace.on_dns_cache_hit.append(self._count('dns_cache_hits'))
+        self._trace.on_dns_cache_miss.append(self._count('dns_cache_misses'))
+        self.stats = dict.fromkeys(
+            ('requests', 'connections_created', 'connections_reused', 'pool_waits', 'dns_cache_hits', 'dns_cache_misses'), 0
+        )
+    
+    def _count(self, name: str):
+        async def handler(session, context, params):
+            self.stats[name] += 1
+        return handler
+    
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        # Создаётся лениво внутри работающего event loop
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive,
+                ttl_dns_cache=self.dns_ttl,
+                ssl=ssl.create_default_context(cafile=certifi.where())
+            )
+        return self._connector
+    
+    def client_session(self, **kwargs) -> aiohttp.ClientSession:
+        """ClientSession поверх общего пула; закрытие сессии не закрывает пул"""
+        kwargs.setdefault('timeout', aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+        return aiohttp.ClientSession(
+            connector=self.connector,
+            connector_owner=False,
+            trace_configs=[self._trace],
+            **kwargs
+        )
+    
+    async def close(self):
+        if self._connector is not None and not self._connector.closed:
+            await self._connector.close()
+    
+    def metrics(self) -> dict:
+        opened = self.stats['connections_created']
+        reused = self.stats['connections_reused']
+        return {
+            **self.stats,
+            'reuse_ratio': reused / (opened + reused) if opened + reused else 0.0,
+            'limit': self.limit,
+            'limit_per_host': self.limit_per_host,
+            'keepalive': self.keepalive,
+            'dns_ttl': self.dns_ttl,
+        }
+
+class SharedPoolAiohttpSession(AiohttpSession):
+    """Сессия aiogram, которая ходит в Bot API через OutboundHTTP вместо собственного коннектора"""
+    
+    def __init__(self, pool: OutboundHTTP, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+    
+    def _client_timeout(self, total: Optional[float]) -> aiohttp.ClientTimeout:
+        # Число вместо ClientTimeout aiohttp превращает в ClientTimeout(total=...), и connect теряется
+        return aiohttp.ClientTimeout(total=total, connect=HTTP_CONNECT_TIMEOUT)
+    
+    async def create_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = self.pool.client_session(
+                headers={'User-Agent': f"aiogram/{aiogram_version} (shared pool)"},
+                timeout=self._client_timeout(self.timeout)
+            )
+        return self._session
+    
+    async def make_request(self, bot: Bot, method, timeout: Optional[float] = None):
+        """Таймаут запроса aiogram (request_timeout или self.timeout) — общий, connect остаётся HTTP_CONNECT_TIMEOUT"""
+        return await super().make_request(bot, method, timeout=self._client_timeout(self.timeout if timeout is None else timeout))
+    
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+outbound_http = OutboundHTTP()
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+bot = Bot(
+    token=BOT_TOKEN,
+    session=SharedPoolAiohttpSession(outbound_http, timeout=HTTP_TIMEOUT),
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+)
 dp = Dispatcher()
 
+class UpdateQueue:
+    """Ограниченная очередь апдейтов: вебхук отвечает сразу, обработку ведут воркеры"""
+    
+    def __init__(self, maxsize: int = UPDATE_QUEUE_SIZE, workers: int = UPDATE_WORKERS, dedup_size: int = UPDATE_DEDUP_SIZE):
+        self.maxsize = maxsize
+        self.workers = workers
+        self._seen = LRUCache(dedup_size)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+    
+    def submit(self, data: dict) -> bool:
+        """Кладёт апдейт в очередь; False, если очередь полна и Telegram должен повторить позже"""
+        self.received += 1
+        update_id = data.get('update_id')
+        if update_id is not None and self._seen.get(update_id) is not None:
+            self.duplicates += 1
+            return True
+        
+        try:
+            self._queue.put_nowait((time.perf_counter(), data))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logger.warning(f"Update queue is full ({self.maxsize}), rejecting update {update_id}")
+            return False
+        
+        if update_id is not None:
+            self._seen.set(update_id, True)
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+    
+    async def put(self, update: types.Update):
+        """Кладёт апдейт из polling, ожидая места в очереди (getUpdates не вызывается, пока очередь полна)"""
+        self.received += 1
+        await self._queue.put((time.perf_counter(), update))
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+    
+    async def start(self, dispatcher: Dispatcher, bot: Bot):
+        self._queue = asyncio.Queue(maxsize=self.maxsize)
+        self._tasks = [
+            asyncio.create_task(self._worker(dispatcher, bot), name=f"update-worker-{i}")
+            for i in range(self.workers)
+        ]
+    
+    async def stop(self, timeout: float = 10.0):
+        """Дообрабатывает очередь (не дольше timeout) и останавливает воркеров"""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Dropping {self._queue.qsize()} unprocessed updates on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def _worker(self, dispatcher: Dispatcher, bot: Bot):
+        while True:
+            enqueued_at, item = await self._queue.get()
+            wait = time.perf_counter() - enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            # Из вебхука приходит сырой dict, из polling — уже разобранный Update
+            is_parsed = isinstance(item, types.Update)
+            update_id = item.update_id if is_parsed else item.get('update_id')
+            try:
+                update = item if is_parsed else types.Update.model_validate(item, context={"bot": bot})
+                await dispatcher.feed_update(bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.exception(f"Update {update_id} failed: {e}")
+            finally:
+                self._queue.task_done()
+    
+    def metrics(self) -> dict:
+        started = self.processed + self.failed
+        return {
+            'depth': self._queue.qsize() if self._queue is not None else 0,
+            'maxsize': self.maxsize,
+            'workers': self.workers,
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'max_depth': self.max_depth,
+            'avg_wait_ms': self.total_wait / started * 1000 if started else 0.0,
+            'max_wait_ms': self.max_wait * 1000,
+        }
+
+update_queue = UpdateQueue()
+history_buffer = HistoryBuffer()
+
+async def poll_updates(bot: Bot, dispatcher: Dispatcher, queue: UpdateQueue, timeout: int = POLLING_TIMEOUT):
+    """Long polling getUpdates в ту же очередь и воркеры, что и в режиме вебхука"""
+    offset = None
+    allowed_updates = dispatcher.resolve_used_update_types()
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset,
+                timeout=timeout,
+                allowed_updates=allowed_updates,
+                request_timeout=timeout + 10
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Polling error: {e}")
+            await asyncio.sleep(1)
+            continue
+        
+        for incoming in updates:
+            await queue.put(incoming)
+            offset = incoming.update_id + 1
+
+def _percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+class SendPriority(IntEnum):
+    HIGH = 0  # Ответы на действия пользователя
+    NORMAL = 1
+    LOW = 2  # Уведомления и рассылки
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class OutgoingMessage:
+    __slots__ = ('chat_id', 'text', 'priority', 'seq', 'kwargs', 'futures', 'enqueued_at')
+    
+    def __init__(self, chat_id: int, text: str, priority: SendPriority, seq: int, kwargs: dict, future: asyncio.Future):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.seq = seq  # Порядок постановки: по нему же сообщение возвращается в очередь после 429
+        self.kwargs = kwargs
+        self.futures = [future]
+        self.enqueued_at = time.monotonic()
+
+class SendScheduler:
+    """Очередь исходящих сообщений: token bucket на чат и глобально, приоритеты и склейка сообщений в один чат"""
+    
+    MAX_TEXT_LENGTH = 4096
+    
+    def __init__(self, bot: Bot, global_rate: float = SEND_GLOBAL_RATE, chat_rate: float = SEND_CHAT_RATE,
+                 group_rate: float = SEND_GROUP_RATE, concurrency: int = SEND_CONCURRENCY):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.concurrency = concurrency
+        # Ёмкость 1: отправка равномерная, без всплеска
+        self._global = TokenBucket(global_rate)
+        # Последние global_rate отправок: [время завершения запроса] (None, пока запрос в пути).
+        # Одна корзина пропускает global_rate + 1 запрос ровно за секунду, а Telegram считает по приходу:
+        # следующая отправка ждёт секунду после завершения отправки, сделанной global_rate запросов назад
+        self._global_window = deque(maxlen=max(1, int(global_rate)))
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._pending: Dict[int, List[tuple]] = {}  # chat_id -> куча (priority, seq, message)
+        self._tail: Dict[int, OutgoingMessage] = {}  # Последнее поставленное в чат и ещё не отправленное
+        self._ready: List[tuple] = []  # (priority, seq, ticket, chat_id) чатов, которые можно слать сейчас
+        self._delayed: List[tuple] = []  # (ready_at, priority, seq, ticket, chat_id)
+        # chat_id -> ticket актуальной записи в _ready/_delayed; записи с другим ticket устарели
+        self._scheduled: Dict[int, int] = {}
+        self._seq = 0
+        self._tickets = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._inflight = set()
+        self.depth = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self._latencies = deque(maxlen=10000)
+    
+    def send_message(self, chat_id: int, text: str, priority: SendPriority = SendPriority.NORMAL, **kwargs) -> asyncio.Future:
+        """Ставит сообщение в очередь; future завершится отправленным Message (общим для склеенных)"""
+        future = asyncio.get_running_loop().create_future()
+        
+        # Склеиваем только с последним сообщением чата: иначе текст обогнал бы сообщения, поставленные раньше него
+        queued = self._tail.get(chat_id)
+        if (queued is not None and queued.priority == priority and queued.kwargs == kwargs
+                and len(queued.text) + len(text) + 2 <= self.MAX_TEXT_LENGTH):
+            queued.text = f"{queued.text}\n\n{text}"
+            queued.futures.append(future)
+            self.coalesced += 1
+            return future
+        
+        self._seq += 1
+        message = OutgoingMessage(chat_id, text, priority, self._seq, kwargs, future)
+        heapq.heappush(self._pending.setdefault(chat_id, []), (priority, self._seq, message))
+        self._tail[chat_id] = message
+        self.depth += 1
+        self._schedule(chat_id)
+        return future
+    
+    def _bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.group_rate if chat_id < 0 else self.chat_rate)
+            self._buckets[chat_id] = bucket
+        return bucket
+    
+    def _schedule(self, chat_id: int, force: bool = False):
+        """Ставит чат в _ready или _delayed по его корзине; force заменяет уже запланированную запись"""
+        if (chat_id in self._scheduled and not force) or not self._pending.get(chat_id):
+            return
+        self._tickets += 1
+        self._scheduled[chat_id] = self._tickets
+        priority, seq, _ = self._pending[chat_id][0]
+        now = time.monotonic()
+        delay = self._bucket(chat_id).delay(now)
+        if delay > 0:
+            heapq.heappush(self._delayed, (now + delay, priority, seq, self._tickets, chat_id))
+        else:
+            heapq.heappush(self._ready, (priority, seq, self._tickets, chat_id))
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._task = asyncio.create_task(self._run(), name="send-scheduler")
+    
+    async def stop(self, timeout: float = 10.0):
+        """Досылает очередь (не дольше timeout) и останавливает планировщик"""
+        deadline = time.monotonic() + timeout
+        while (self.depth or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+    
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, seq, ticket, chat_id = heapq.heappop(self._delayed)
+                if self._scheduled.get(chat_id) == ticket:
+                    heapq.heappush(self._ready, (priority, seq, ticket, chat_id))
+            
+            if not self._ready:
+                timeout = self._delayed[0][0] - now if self._delayed else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            global_delay = self._global.delay(now)
+            if len(self._global_window) == self._global_window.maxlen:
+                completed_at = self._global_window[0][0]
+                if completed_at is None:
+                    # Запрос из начала окна ещё в пути: _deliver разбудит цикл, когда он завершится
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                global_delay = max(global_delay, completed_at + 1.0 - now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+            
+            _, _, ticket, chat_id = heapq.heappop(self._ready)
+            if self._scheduled.get(chat_id) != ticket:
+                # Чат перепланирован (например, после 429), эта запись устарела
+                continue
+            del self._scheduled[chat_id]
+            pending = self._pending.get(chat_id)
+            if not pending:
+                continue
+            if self._bucket(chat_id).delay(now) > 0:
+                self._schedule(chat_id)
+                continue
+            _, _, message = heapq.heappop(pending)
+            if not pending:
+                del self._pending[chat_id]
+            if self._tail.get(chat_id) is message:
+                del self._tail[chat_id]
+            self.depth -= 1
+            
+            self._global.take(now)
+            slot = [None]
+            self._global_window.append(slot)
+            self._bucket(chat_id).take(now)
+            await self._semaphore.acquire()
+            task = asyncio.create_task(self._deliver(message, slot))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+            self._schedule(chat_id)
+            self._prune_buckets(now)
+    
+    async def _deliver(self, message: OutgoingMessage, slot: list):
+        try:
+            result = await self.bot.send_message(message.chat_id, message.text, **message.kwargs)
+        except TelegramRetryAfter as e:
+            # Flood control: чат ждёт retry_after, сообщение возвращается в очередь на своё прежнее место.
+            # Уже запланированная запись чата рассчитана по старой корзине, поэтому заменяется новой
+            self.retried += 1
+            bucket = self._bucket(message.chat_id)
+            bucket.tokens = 1 - e.retry_after * bucket.rate
+            bucket.updated = time.monotonic()
+            heapq.heappush(self._pending.setdefault(message.chat_id, []), (message.priority, message.seq, message))
+            self._tail.setdefault(message.chat_id, message)
+            self.depth += 1
+            self._schedule(message.chat_id, force=True)
+            return
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Failed to send message to {message.chat_id}: {e}")
+            for future in message.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            slot[0] = time.monotonic()
+            self._semaphore.release()
+            self._wakeup.set()
+        
+        self.sent += 1
+        self._latencies.append(time.monotonic() - message.enqueued_at)
+        for future in message.futures:
+            if not future.done():
+                future.set_result(result)
+    
+    def _prune_buckets(self, now: float):
+        # Полные корзины ничем не отличаются от новых, их можно забыть
+        if len(self._buckets) > 10000:
+            for chat_id in [chat_id for chat_id, bucket in self._buckets.items() if chat_id not in self._pending and bucket.is_full(now)]:
+                del self._buckets[chat_id]
+    
+    def metrics(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            'depth': self.depth,
+            'chats_waiting': len(self._pending),
+            'inflight': len(self._inflight),
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retried': self.retried,
+            'failed': self.failed,
+            'latency_p50_ms': _percentile(latencies, 50) * 1000,
+            'latency_p99_ms': _percentile(latencies, 99) * 1000,
+        }
+
+send_scheduler = SendScheduler(bot)
+
 # FastAPI приложение
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # При запуске
-    webhook_url = f"{WEBHOOK_URL}/webhook"
-    await bot.set_webhook(url=webhook_url, allowed_updates=dp.resolve_used_update_types())
-    logger.info(f"Webhook set to {webhook_url}")
+    run_migrations()
+    get_mini_app_page()
+    async with AsyncSessionLocal() as db:
+        await leaderboards.arebuild(db)
+    await history_buffer.start()
+    await stats_rollup.start()
+    await drop_telemetry.start()
+    await update_queue.start(dp, bot)
+    await send_scheduler.start()
+    polling = None
+    if RUN_MODE == "polling":
+        await bot.delete_webhook()
+        polling = asyncio.create_task(poll_updates(bot, dp, update_queue))
+        logger.info(f"Polling started with {update_queue.workers} workers")
+    else:
+        webhook_url = f"{WEBHOOK_URL}/webhook"
+        await bot.set_webhook(url=webhook_url, allowed_updates=dp.resolve_used_update_types(), secret_token=WEBHOOK_SECRET)
+        logger.info(f"Webhook set to {webhook_url}")
     yield
     # При завершении
-    await bot.delete_webhook()
+    if polling is not None:
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+    else:
+        await bot.delete_webhook()
+    await update_queue.stop()
+    await send_scheduler.stop()
+    # Открытия больше не приходят: дописываем историю до закрытия пула соединений
+    await history_buffer.stop()
+    await stats_rollup.stop()
+    await drop_telemetry.stop()
     await bot.session.close()
+    await outbound_http.close()
+    await async_engine.dispose()
 
 app = FastAPI(lifespan=lifespan)
 
@@ -319,6 +3291,365 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# API
+@app.post("/webhook")
+async def webhook(request: Request):
+    """Приём апдейта от Telegram: ответ сразу, обработка в воркерах UpdateQueue"""
+    # Без проверки секрета поддельные апдейты с будущими update_id вытесняли бы настоящие как дубликаты
+    if not hmac.compare_digest(request.headers.get('x-telegram-bot-api-secret-token', ''), WEBHOOK_SECRET):
+        raise HTTPException(status_code=403)
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Update must be a JSON object")
+    
+    if not update_queue.submit(data):
+        # Очередь переполнена: Telegram повторит доставку позже
+        return Response(status_code=503)
+    return Response(status_code=200)
+
+@app.get("/internal/metrics")
+async def metrics_endpoint(request: Request):
+    """Внутренние метрики процесса, доступны только с METRICS_TOKEN"""
+    if not METRICS_TOKEN or not hmac.compare_digest(request.headers.get('x-metrics-token', ''), METRICS_TOKEN):
+        raise HTTPException(status_code=404)
+    return {
+        'update_queue': update_queue.metrics(),
+        'send_scheduler': send_scheduler.metrics(),
+        'outbound_http': outbound_http.metrics(),
+        'history_buffer': history_buffer.metrics(),
+        'stats_rollup': stats_rollup.metrics(),
+        'drop_telemetry': drop_telemetry.metrics(),
+    }
+
+@app.get("/internal/stats")
+async def stats_endpoint(
+    request: Request,
+    granularity: str = Query('day', pattern='^(hour|day)$'),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    case_id: Optional[List[int]] = Query(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Открытия, выручка и выплаты по кейсам и редкостям из агрегатов, только с ADMIN_API_TOKEN"""
+    if not ADMIN_API_TOKEN or not hmac.compare_digest(request.headers.get('x-admin-token', ''), ADMIN_API_TOKEN):
+        raise HTTPException(status_code=404)
+    return await get_opening_stats(db, granularity, start, end, case_id)
+
+@app.get("/internal/drop-rates")
+async def drop_rates_endpoint(
+    request: Request,
+    case_id: Optional[List[int]] = Query(None),
+    alpha: float = Query(DROP_ALERT_P_VALUE, gt=0, lt=1),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Фактические выпадения против CaseNFT.chance по каждому кейсу, только с ADMIN_API_TOKEN"""
+    if not ADMIN_API_TOKEN or not hmac.compare_digest(request.headers.get('x-admin-token', ''), ADMIN_API_TOKEN):
+        raise HTTPException(status_code=404)
+    return await get_drop_report(db, case_id, alpha)
+
+@app.get("/internal/export")
+async def export_endpoint(
+    request: Request,
+    format: str = Query('ndjson', pattern='^(ndjson|csv)$'),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    case_id: Optional[List[int]] = Query(None),
+    gzip: bool = False,
+    after_created: Optional[datetime] = None,
+    after_id: Optional[int] = None
+):
+    """Потоковая выгрузка opening_history с кейсами, NFT и пользователями, только с ADMIN_API_TOKEN"""
+    if not ADMIN_API_TOKEN or not hmac.compare_digest(request.headers.get('x-admin-token', ''), ADMIN_API_TOKEN):
+        raise HTTPException(status_code=404)
+    
+    if (after_created is None) != (after_id is None):
+        raise HTTPException(status_code=400, detail="after_created и after_id задаются вместе")
+    after = (after_created, after_id) if after_id is not None else None
+    
+    filename = f"opening_history.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(
+        export_opening_history(format, start, end, case_id, compress=gzip, after=after),
+        media_type="application/gzip" if gzip else EXPORT_FORMATS[format],
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/")
+async def mini_app_page(request: Request):
+    """Mini App: предсжатая страница, 304 при совпадении ETag"""
+    return get_mini_app_page().response(request)
+
+async def get_user_by_init_data(db: AsyncSession, init_data: str) -> User:
+    """Проверка init_data и получение (или создание) пользователя"""
+    if not AuthService.verify_telegram_init_data(init_data):
+        raise HTTPException(status_code=401, detail="Неверные данные авторизации")
+    
+    user_data = AuthService.get_user_data(init_data)
+    if not user_data or 'id' not in user_data:
+        raise HTTPException(status_code=401, detail="Неверные данные авторизации")
+    
+    return await AsyncUserService.get_or_create_user(
+        db,
+        user_data['id'],
+        user_data.get('username'),
+        user_data.get('first_name'),
+        user_data.get('last_name')
+    )
+
+_bearer = HTTPBearer(auto_error=False)
+
+async def get_session_user(credentials: Optional[HTTPAuthorizationCredentials] = Depends(_bearer)) -> SessionUser:
+    """FastAPI-зависимость: пользователь из токена Authorization: Bearer"""
+    if credentials is None:
+        raise HTTPException(status_code=401, detail="Требуется авторизация")
+    
+    session_user = AuthService.decode_session_token(credentials.credentials)
+    if session_user is None:
+        raise HTTPException(status_code=401, detail="Сессия истекла или недействительна")
+    return session_user
+
+@app.post("/api/auth")
+async def auth_endpoint(request: InitDataRequest, db: AsyncSession = Depends(get_async_db)):
+    """Обмен init_data на сессионный токен для последующих запросов"""
+    user = await get_user_by_init_data(db, request.init_data)
+    if PROVABLY_FAIR and user.fair_seed_id is None:
+        await FairnessService.aensure_seed(db, user.id)
+    leaderboards.set_name(user.id, user.username, user.first_name)
+    return {
+        'token': AuthService.issue_session_token(user.telegram_id, user.id),
+        'expires_in': SESSION_TOKEN_TTL,
+        'balance': user.stars_balance
+    }
+
+@app.get("/api/cases")
+async def cases_endpoint(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """Каталог кейсов (формат CaseSchema): JSON собирается один раз на версию каталога"""
+    body, etag = await case_catalog.acases_payload(db)
+    # no-cache: клиент хранит копию, но перед использованием сверяет ETag
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+def _encode_inventory_cursor(item: dict) -> str:
+    return f"{item['created_at'].isoformat()}_{item['id']}"
+
+def _decode_inventory_cursor(cursor: str) -> tuple:
+    try:
+        created_at, last_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(last_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Неверный курсор")
+
+@app.get("/api/profile")
+async def profile_endpoint(
+    session_user: SessionUser = Depends(get_session_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Баланс, счётчики и сводка инвентаря по редкостям (количество и стоимость продажи)"""
+    profile = await AsyncUserService.get_profile(db, session_user.user_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    return profile
+
+@app.get("/api/leaderboard")
+async def leaderboard_endpoint(
+    board: str = Query('spent', pattern='^(spent|opens|best_drop)$'),
+    window: str = Query('all', pattern='^(all|day|week)$'),
+    limit: int = Query(10, ge=1, le=LEADERBOARD_SIZE)
+):
+    """Топ игроков из памяти процесса: spent, opens или best_drop за all, day или week"""
+    return {'board': board, 'window': window, 'entries': leaderboards.top(board, window, limit)}
+
+@app.get("/api/inventory")
+async def inventory_endpoint(
+    limit: int = Query(50, ge=1, le=200),
+    cursor: Optional[str] = None,
+    rarity: Optional[str] = None,
+    nft_id: Optional[int] = None,
+    session_user: SessionUser = Depends(get_session_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Инвентарь постранично; next_cursor передаётся в следующий запрос как cursor"""
+    after = _decode_inventory_cursor(cursor) if cursor else None
+    items = await AsyncUserService.get_user_nfts_page(db, session_user.user_id, limit, after, rarity, nft_id)
+    next_cursor = _encode_inventory_cursor(items[-1]) if len(items) == limit else None
+    
+    return {
+        'items': [
+            {
+                'id': item['id'],
+                'nft_id': item['nft_id'],
+                'name': item['name'],
+                'rarity': item['rarity'],
+                'price': item['price'],
+                'image_url': item['image_url']
+            }
+            for item in items
+        ],
+        'next_cursor': next_cursor
+    }
+
+@app.post("/api/inventory/sell")
+async def sell_nfts_endpoint(
+    request: SellNFTsRequest,
+    session_user: SessionUser = Depends(get_session_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Массовая продажа по списку id или по фильтру; sold — пары [user_nft_id, sold_price]"""
+    if request.user_nft_ids is None and request.rarity is None and request.nft_id is None and not request.all:
+        raise HTTPException(status_code=400, detail="Не выбраны NFT для продажи")
+    
+    result = await AsyncUserService.sell_nfts(
+        db,
+        session_user.user_id,
+        request.user_nft_ids,
+        request.rarity,
+        request.nft_id
+    )
+    if result is None:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    return result
+
+@app.post("/api/cases/{case_id}/open")
+async def open_case_endpoint(
+    case_id: int,
+    count: int = Query(1, ge=1, le=MAX_OPEN_COUNT),
+    session_user: SessionUser = Depends(get_session_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Открытие кейса count раз за один запрос; results — пары [user_nft_id, nft_id]"""
+    try:
+        result = await AsyncCaseService.open_cases_transaction(db, session_user.user_id, case_id, count, history_buffer)
+    except InsufficientBalanceError:
+        raise HTTPException(status_code=400, detail="Недостаточно звезд")
+    except FairnessSeedMissingError:
+        raise HTTPException(status_code=409, detail="Нет пары сидов: повторите авторизацию")
+    
+    if result is None:
+        raise HTTPException(status_code=404, detail="Кейс не найден")
+    
+    return {
+        'balance': result['balance'],
+        'results': [list(pair) for pair in zip(result['user_nft_ids'], result['nft_ids'])]
+    }
+
+@app.get("/api/fairness")
+async def fairness_endpoint(
+    session_user: SessionUser = Depends(get_session_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Активная пара сидов: хэш server_seed, client_seed и nonce следующего открытия"""
+    return await FairnessService.aget_state(db, session_user.user_id)
+
+@app.post("/api/fairness/rotate")
+async def rotate_seed_endpoint(
+    request: RotateSeedRequest,
+    session_user: SessionUser = Depends(get_session_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Смена пары сидов: в previous раскрывается прежний server_seed для проверки открытий"""
+    if request.client_seed is not None and not 1 <= len(request.client_seed) <= 64:
+        raise HTTPException(status_code=400, detail="client_seed должен быть от 1 до 64 символов")
+    return await FairnessService.arotate(db, session_user.user_id, request.client_seed)
+
+def main(argv: Optional[List[str]] = None):
+    """Запуск: python main.py [--polling] [--parallelism N] | migrate [--check] | simulate | verify-fairness | export | rollup.
+    Бенчмарки — отдельно: python bench.py <имя>"""
+    global RUN_MODE
+    parser = argparse.ArgumentParser(description="Gift Battle bot and Mini App server")
+    parser.add_argument("--polling", action="store_true", help="long polling вместо вебхука (без публичного URL)")
+    parser.add_argument("--parallelism", type=int, default=UPDATE_WORKERS, help="сколько апдейтов обрабатывать одновременно")
+    parser.add_argument("--port", type=int, default=PORT)
+    commands = parser.add_subparsers(dest="command")
+    migrate = commands.add_parser("migrate", help="применить миграции схемы")
+    migrate.add_argument("--check", action="store_true", help="проверить планы запросов через EXPLAIN")
+    simulate = commands.add_parser("simulate", help="Monte Carlo RTP и проверка шансов кейсов")
+    simulate.add_argument("--case", type=int, action="append", dest="case_ids", help="id кейса (можно несколько)")
+    simulate.add_argument("--draws", type=int, default=10_000_000)
+    simulate.add_argument("--seed", type=int)
+    simulate.add_argument("--alpha", type=float, default=1e-4, help="порог p-value для хи-квадрат")
+    simulate.add_argument("--self-test", action="store_true", help="проверить движок на синтетическом кейсе")
+    verify = commands.add_parser("verify-fairness", help="перепроверить provably fair открытия из истории")
+    verify.add_argument("--chunk", type=int, default=50_000, help="строк истории за одну порцию")
+    verify.add_argument("--after-id", type=int, default=0, help="начать после этого opening_history.id")
+    export = commands.add_parser("export", help="выгрузить opening_history в NDJSON или CSV")
+    export.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="ndjson")
+    export.add_argument("--from", dest="start", type=datetime.fromisoformat, help="с даты (UTC, включительно)")
+    export.add_argument("--to", dest="end", type=datetime.fromisoformat, help="по дату (UTC, не включая)")
+    export.add_argument("--case", type=int, action="append", dest="case_ids", help="id кейса (можно несколько)")
+    export.add_argument("--gzip", action="store_true", help="сжимать gzip на лету")
+    export.add_argument("--after-created", type=datetime.fromisoformat, help="продолжить после строки с этим created_at (вместе с --after-id)")
+    export.add_argument("--after-id", type=int, help="продолжить после строки с этим id (вместе с --after-created)")
+    export.add_argument("--output", "-o", help="файл (по умолчанию stdout)")
+    commands.add_parser("rollup", help="догнать почасовые и посуточные агрегаты статистики")
+    args = parser.parse_args(argv)
+    
+    if args.command == "migrate":
+        run_migrations()
+        if args.check:
+            for name, plan in check_query_plans().items():
+                print(f"{name}: {'; '.join(plan)}")
+        return
+    
+    if args.command == "simulate":
+        if args.self_test:
+            simulation_self_test(args.draws, args.alpha)
+            return
+        with SessionLocal() as db:
+            results = simulate_cases(db, args.case_ids, args.draws, args.seed)
+        for case_id, result in results.items():
+            _print_simulation(case_id, result)
+        failed = [case_id for case_id, result in results.items() if result['p_value'] < args.alpha]
+        if failed:
+            raise SystemExit(f"Chi-square p-value below {args.alpha} for cases {failed}")
+        return
+    
+    if args.command == "verify-fairness":
+        with SessionLocal() as db:
+            report = verify_fairness(db, args.chunk, args.after_id)
+        print(f"checked {report['checked']:,} openings up to id {report['last_id']} at {report['rows_per_sec']:,.0f}/s")
+        print(f"roll mismatches: {report['roll_mismatches']} {report['roll_mismatch_ids']}")
+        print(f"outcome mismatches: {report['outcome_mismatches']} {report['outcome_mismatch_ids']}, unverifiable: {report['unverifiable']}, "
+              f"odds changed since opening: {report['unverifiable_odds_changed']}")
+        if report['roll_mismatches']:
+            raise SystemExit("Provably fair rolls do not match stored history")
+        return
+    
+    if args.command == "export":
+        if (args.after_created is None) != (args.after_id is None):
+            parser.error("--after-created and --after-id go together")
+        after = (args.after_created, args.after_id) if args.after_id is not None else None
+        
+        async def write_export():
+            output = open(args.output, "wb") if args.output else sys.stdout.buffer
+            try:
+                async for data in export_opening_history(args.format, args.start, args.end, args.case_ids, args.gzip, after=after):
+                    output.write(data)
+            finally:
+                if args.output:
+                    output.close()
+                await async_engine.dispose()
+        asyncio.run(write_export())
+        return
+    
+    if args.command == "rollup":
+        async def run_rollup():
+            try:
+                rows = await stats_rollup.run_once()
+            finally:
+                await async_engine.dispose()
+            print(f"aggregated {rows:,} openings, watermark {stats_rollup.watermark}")
+        asyncio.run(run_rollup())
+        return
+    
+    if args.polling:
+        RUN_MODE = "polling"
+    update_queue.workers = args.parallelism
+    uvicorn.run(app, host="0.0.0.0", port=args.port)
+
 # HTML шаблон Mini App
 HTML_TEMPLATE = """
 <!DOCTYPE html>
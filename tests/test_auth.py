@@ -0,0 +1,45 @@
+import hashlib
+import hmac
+import os
+import time
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./test_bot.db")
+
+from fastapi.testclient import TestClient
+
+from main import INIT_DATA_MAX_AGE, WEBAPP_SECRET_KEY, AuthService, app
+
+
+def _signed_init_data(**fields) -> str:
+    """init_data с корректной подписью Telegram для заданных полей"""
+    data_check_string = '\n'.join(f"{k}={v}" for k, v in sorted(fields.items()))
+    hash_value = hmac.new(WEBAPP_SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return '&'.join(f"{k}={v}" for k, v in fields.items()) + f"&hash={hash_value}"
+
+
+def setup_function():
+    AuthService._verified.clear()
+
+
+def test_fresh_init_data_is_accepted():
+    init_data = _signed_init_data(auth_date=int(time.time()), query_id="fresh")
+    assert AuthService.verify_telegram_init_data(init_data)
+
+
+def test_stale_init_data_is_rejected():
+    init_data = _signed_init_data(auth_date=int(time.time()) - INIT_DATA_MAX_AGE - 1, query_id="stale")
+    assert not AuthService.verify_telegram_init_data(init_data)
+
+
+def test_missing_auth_date_is_rejected():
+    init_data = _signed_init_data(query_id="no-date")
+    assert not AuthService.verify_telegram_init_data(init_data)
+
+
+def test_auth_endpoint_returns_401_for_stale_init_data():
+    init_data = _signed_init_data(auth_date=int(time.time()) - INIT_DATA_MAX_AGE - 1, query_id="stale")
+    # Без with: lifespan не запускается и не ходит в Telegram, а до базы запрос не доходит
+    response = TestClient(app).post("/api/auth", json={"init_data": init_data})
+    assert response.status_code == 401
+    assert 'token' not in response.json()
@@ -0,0 +1,34 @@
+import os
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DATABASE_URL", "sqlite:///./test_bot.db")
+
+from fastapi.testclient import TestClient
+
+from main import MAX_SELL_IDS, AuthService, app, run_migrations
+
+
+def setup_module():
+    run_migrations()
+
+
+def _auth_headers(user_id: int) -> dict:
+    return {'Authorization': f"Bearer {AuthService.issue_session_token(user_id, user_id)}"}
+
+
+def test_sell_rejects_too_many_ids():
+    response = TestClient(app).post(
+        "/api/inventory/sell",
+        json={"user_nft_ids": list(range(MAX_SELL_IDS + 1))},
+        headers=_auth_headers(1)
+    )
+    assert response.status_code == 422
+
+
+def test_sell_for_missing_user_returns_404():
+    response = TestClient(app).post(
+        "/api/inventory/sell",
+        json={"all": True},
+        headers=_auth_headers(10 ** 9)
+    )
+    assert response.status_code == 404